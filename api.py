@@ -0,0 +1,307 @@
+"""Versioned JSON API for integrations (/api/v1).
+
+ERP and BI tools read products, stock levels, bills and receptions here
+instead of scraping the HTML pages. Every list endpoint takes:
+
+    fields=code,name,quantity   only these fields (cursor fields are always included)
+    limit=100                   page size, at most 1000; no default cap when streaming
+    format=ndjson               stream one JSON object per line instead of a page
+    Accept-Encoding: gzip       compress the response, streamed for NDJSON
+
+Paging is by keyset cursor: follow the `next` URL of a JSON page, or resume
+from the cursor fields of the last NDJSON line. Products and stock rows are
+ordered by (updated_at, id), so an integration that keeps its last cursor and
+polls with since=&after_id= only gets what changed since then. Finished bills
+and receptions never change; they are ordered by id and pulled with after_id=.
+Delta pulls do not report deleted products; a full fields=id pull does.
+
+Rows are stamped when they are written, not when their transaction commits,
+so a row from a slow transaction can commit after a poll has already moved
+past its timestamp or id. Rows written in the last API_CHANGE_LAG_SECONDS are
+therefore held back until a later poll, which keeps cursors from skipping them.
+
+Requests need "Authorization: Bearer <API_TOKEN>"; the API is off while
+API_TOKEN is unset.
+"""
+import gzip
+import heapq
+import hmac
+import json
+import zlib
+from datetime import datetime, timedelta
+from itertools import islice
+
+from flask import Blueprint, Response, jsonify, request, stream_with_context, url_for
+from sqlalchemy import and_, func, or_, select
+
+from app import app, db
+from models import Product, ProductStock, Location
+from stock import current_site, site_filter
+from archive import DOCUMENTS, is_postgres
+from lines import lines_by_document
+
+api = Blueprint('api_v1', __name__, url_prefix='/api/v1')
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Rows fetched per round trip while streaming, and documents per line query
+STREAM_BATCH_SIZE = 1000
+
+PRODUCT_FIELDS = {
+    'id': Product.id,
+    'code': Product.code,
+    'name': Product.name,
+    'unit': Product.unit,
+    'quantity': Product.quantity,
+    'location': Product.location,
+    'min_stock': Product.min_stock,
+    'created_at': Product.created_at,
+    'updated_at': Product.updated_at,
+}
+
+STOCK_FIELDS = {
+    'id': ProductStock.id,
+    'product_id': ProductStock.product_id,
+    'product_code': Product.code,
+    'location_id': ProductStock.location_id,
+    'location': Location.code,
+    'site': Location.site,
+    'quantity': ProductStock.quantity,
+    'updated_at': ProductStock.updated_at,
+}
+
+
+class ApiError(Exception):
+    """Request error reported as {"error": message}"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+@api.errorhandler(ApiError)
+def api_error(error):
+    return jsonify({'error': error.message}), error.status
+
+
+@api.before_request
+def require_token():
+    token = app.config['API_TOKEN']
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not token or not hmac.compare_digest(supplied, token):
+        raise ApiError('Acces neautorizat', 403)
+
+
+def accepts_gzip():
+    return 'gzip' in request.headers.get('Accept-Encoding', '')
+
+
+def gzip_json(payload):
+    """JSON response, gzip-compressed when the client accepts it"""
+    body = json.dumps(payload, default=str).encode()
+    response = Response(body, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if accepts_gzip():
+        response.set_data(gzip.compress(body))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def _gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _stream(records):
+    """NDJSON response written while rows are still being read"""
+    chunks = (json.dumps(record, default=str).encode() + b'\n' for record in records)
+    compressed = accepts_gzip()
+    response = Response(stream_with_context(_gzip_chunks(chunks) if compressed else chunks),
+                        mimetype='application/x-ndjson')
+    response.vary.add('Accept-Encoding')
+    if compressed:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def _streaming():
+    return request.args.get('format') == 'ndjson'
+
+
+def _limit():
+    limit = request.args.get('limit', type=int)
+    if _streaming():
+        return limit
+    return max(1, min(limit or PAGE_SIZE, MAX_PAGE_SIZE))
+
+
+def _since():
+    since = request.args.get('since')
+    if not since:
+        return None
+    try:
+        return datetime.fromisoformat(since)
+    except ValueError:
+        raise ApiError('Parametrul since nu este valid')
+
+
+def _selected(available, cursor_fields):
+    """Requested fields in request order, cursor fields first; all fields by default"""
+    requested = [name.strip() for name in request.args.get('fields', '').split(',') if name.strip()]
+    if not requested:
+        return list(available)
+    unknown = sorted(set(requested) - set(available))
+    if unknown:
+        raise ApiError(f'Câmpuri necunoscute: {", ".join(unknown)}')
+    return list(dict.fromkeys([*cursor_fields, *requested]))
+
+
+def _record(row, names):
+    return {name: value.isoformat() if isinstance(value, datetime) else value
+            for name, value in zip(names, row)}
+
+
+def _respond(records, limit, next_args):
+    """Stream records as NDJSON, or return one page with the URL of the next"""
+    if _streaming():
+        return _stream(records)
+    page = list(records)
+    next_url = None
+    if len(page) == limit:
+        next_url = url_for(request.endpoint, **{**request.args.to_dict(), **next_args(page[-1])})
+    return gzip_json({'data': page, 'next': next_url})
+
+
+def _execute(query):
+    return db.session.execute(query.execution_options(yield_per=STREAM_BATCH_SIZE))
+
+
+def _settled():
+    """Rows stamped before this belong to transactions that have had time to commit"""
+    return datetime.utcnow() - timedelta(seconds=app.config['API_CHANGE_LAG_SECONDS'])
+
+
+def _changed_since(query, updated_at, id_column):
+    query = query.where(or_(updated_at.is_(None), updated_at < _settled()))
+    since = _since()
+    if since is None:
+        return query
+    after_id = request.args.get('after_id', 0, type=int)
+    return query.where(or_(updated_at > since, and_(updated_at == since, id_column > after_id)))
+
+
+def _delta_cursor(record):
+    return {'since': record['updated_at'], 'after_id': record['id']}
+
+
+@api.route('/products')
+def products():
+    """Catalog rows ordered by (updated_at, id); quantity is the total over all sites"""
+    names = _selected(PRODUCT_FIELDS, ('id', 'updated_at'))
+    limit = _limit()
+    query = (
+        select(*[PRODUCT_FIELDS[name] for name in names])
+        .order_by(Product.updated_at, Product.id)
+        .limit(limit)
+    )
+    query = _changed_since(query, Product.updated_at, Product.id)
+    return _respond((_record(row, names) for row in _execute(query)), limit, _delta_cursor)
+
+
+@api.route('/stock')
+def stock():
+    """Per-location stock rows of this instance's site, ordered by (updated_at, id)"""
+    names = _selected(STOCK_FIELDS, ('id', 'updated_at'))
+    limit = _limit()
+    query = (
+        select(*[STOCK_FIELDS[name] for name in names])
+        .select_from(ProductStock)
+        .join(Product, Product.id == ProductStock.product_id)
+        .join(Location, Location.id == ProductStock.location_id)
+        .order_by(ProductStock.updated_at, ProductStock.id)
+        .limit(limit)
+    )
+    query = site_filter(_changed_since(query, ProductStock.updated_at, ProductStock.id), current_site())
+    return _respond((_record(row, names) for row in _execute(query)), limit, _delta_cursor)
+
+
+def _line_record(line):
+    return {
+        'item_number': line.item_number,
+        'product_id': line.product_id,
+        'product_code': line.product_code,
+        'product_name': line.product_name,
+        'unit': line.unit,
+        'quantity': line.quantity,
+        'location': line.location,
+    }
+
+
+def _with_items(kind, rows, names):
+    """Document records with their lines, loaded with one query per batch of documents"""
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, STREAM_BATCH_SIZE))
+        if not batch:
+            return
+        lines = {}
+        for archived in (False, True):
+            lines.update(lines_by_document(kind, [row.id for row, in_archive in batch if in_archive == archived],
+                                           archived))
+        for row, _ in batch:
+            record = _record(row, names)
+            record['items'] = [_line_record(line) for line in lines.get(row.id, [])]
+            yield record
+
+
+def _documents(kind):
+    """Finished documents of the site after after_id, live and archived, ordered by id"""
+    documents, archived, date_column, _, _, _ = DOCUMENTS[kind]
+    names = _selected([column.name for column in documents.columns], ('id',))
+    limit = _limit()
+    after_id = request.args.get('after_id', 0, type=int)
+    site = current_site()
+    # Stop before the first recent document: ids after it may still be committing
+    unsettled_id = db.session.execute(
+        select(func.min(documents.c.id)).where(documents.c[date_column] >= _settled())).scalar()
+
+    def read(table, in_archive):
+        query = (
+            select(*[table.c[name] for name in names])
+            .where(table.c.id > after_id, table.c.is_finished.is_(True))
+            .order_by(table.c.id)
+            .limit(limit)
+        )
+        if unsettled_id is not None:
+            query = query.where(table.c.id < unsettled_id)
+        if site is not None:
+            query = query.where(table.c.site == site)
+        return ((row, in_archive) for row in _execute(query))
+
+    sources = [read(documents, False)] if is_postgres() else [read(documents, False), read(archived, True)]
+    rows = heapq.merge(*sources, key=lambda pair: pair[0].id)
+    if limit is not None:
+        rows = islice(rows, limit)
+
+    if request.args.get('include') == 'items':
+        records = _with_items(kind, rows, names)
+    else:
+        records = (_record(row, names) for row, _ in rows)
+    return _respond(records, limit, lambda record: {'after_id': record['id']})
+
+
+@api.route('/bills')
+def bills():
+    """Finished consumption bills; include=items adds their lines"""
+    return _documents('bill')
+
+
+@api.route('/receptions')
+def receptions():
+    """Finished reception sheets; include=items adds their lines"""
+    return _documents('reception')
@@ -1,17 +1,22 @@
 import os
-import logging
-from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, flash, session, send_file, jsonify
+from datetime import datetime, timedelta
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, session, send_file, jsonify
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.exc import IntegrityError
 import openpyxl
 from openpyxl.styles import Font, Alignment, Border, Side
 from openpyxl.utils import get_column_letter
 import io
+import gzip
+import json
+import hmac
+import socket
+import click
 
-# Configure logging for debugging
-logging.basicConfig(level=logging.DEBUG)
+from logging_setup import configure_logging
 
 class Base(DeclarativeBase):
     pass
@@ -21,84 +26,1233 @@ db = SQLAlchemy(model_class=Base)
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-change-in-production")
 
-# Configure logging for debugging
-logging.basicConfig(level=logging.DEBUG)
+# Structured logs written off the request thread; levels come from LOG_LEVEL / LOG_LEVELS
+configure_logging(app)
 
-class Base(DeclarativeBase):
-    pass
+# Edge node: serve terminals from a local SQLite database and sync with CENTRAL_URL in the background
+app.config["EDGE_MODE"] = os.environ.get("EDGE_MODE", "").lower() in ("1", "true", "yes")
+app.config["EDGE_NODE_ID"] = os.environ.get("EDGE_NODE_ID") or socket.gethostname()
+app.config["CENTRAL_URL"] = os.environ.get("CENTRAL_URL", "")
+app.config["EDGE_SYNC_BATCH_SIZE"] = int(os.environ.get("EDGE_SYNC_BATCH_SIZE", "200"))
+app.config["EDGE_SYNC_INTERVAL"] = float(os.environ.get("EDGE_SYNC_INTERVAL", "30"))
 
-db = SQLAlchemy(model_class=Base)
+# How long finalize/batch idempotency keys are kept for replaying retries
+app.config["IDEMPOTENCY_KEY_TTL_HOURS"] = float(os.environ.get("IDEMPOTENCY_KEY_TTL_HOURS", "24"))
 
-app = Flask(__name__)
-app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-change-in-production")
+# Shared secret for /sync/*; the endpoints are disabled when unset
+app.config["SYNC_TOKEN"] = os.environ.get("SYNC_TOKEN", "")
+
+# Bearer token for the /api/v1 integration API; the API is disabled when unset
+app.config["API_TOKEN"] = os.environ.get("API_TOKEN", "")
+# Rows this recent are left for the next API poll, so cursors don't skip transactions still committing
+app.config["API_CHANGE_LAG_SECONDS"] = float(os.environ.get("API_CHANGE_LAG_SECONDS", "10"))
 
 # Configure the database for Render (PostgreSQL)
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///local.db").replace("postgres://", "postgresql://", 1)
+default_database = "sqlite:///edge.db" if app.config["EDGE_MODE"] else "sqlite:///local.db"
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", default_database).replace("postgres://", "postgresql://", 1)
 app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_recycle": 300,
     "pool_pre_ping": True,
 }
 
-db.init_app(app)
+# Site served by this instance; terminals of a site only see and move that site's stock
+app.config["INVENTORY_SITE"] = os.environ.get("INVENTORY_SITE") or None
 
-# Import models after app initialization
-from models import Product, ConsumptionBill, BillItem, ReceptionSheet, ReceptionItem, DraftBill, DraftBillItem, DraftReception, DraftReceptionItem
+# Finished bills and receptions older than this move to cold storage (archive tables or old partitions)
+app.config["ARCHIVE_AFTER_DAYS"] = int(os.environ.get("ARCHIVE_AFTER_DAYS", "365"))
+
+# Product lookup cache: entries per worker, and how often a worker re-reads the catalog version
+app.config["PRODUCT_CACHE_SIZE"] = int(os.environ.get("PRODUCT_CACHE_SIZE", "10000"))
+app.config["PRODUCT_CACHE_CHECK_SECONDS"] = float(os.environ.get("PRODUCT_CACHE_CHECK_SECONDS", "0.5"))
+
+# Open /events streams per worker; each holds a gunicorn thread, so keep it below --threads
+app.config["SSE_MAX_CLIENTS"] = int(os.environ.get("SSE_MAX_CLIENTS", "300"))
+
+# How often a worker checks whether the product-picker payload needs rebuilding
+app.config["CATALOG_PAYLOAD_CHECK_SECONDS"] = float(os.environ.get("CATALOG_PAYLOAD_CHECK_SECONDS", "30"))
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL and relaxed fsync for SQLite: readers don't block the writer, commits don't wait on the disk.
+
+    SQLite ignores declared foreign keys unless asked, so ON DELETE SET NULL/CASCADE
+    on product references would never run.
+    """
+    if dbapi_connection.__class__.__module__.split('.')[0] != 'sqlite3':
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
 
-def init_db():
-    """Initialize database tables"""
-    with app.app_context():
-        db.create_all()
-# Initialize the app with the extension
 db.init_app(app)
 
 # Import models after app initialization
-from models import Product, ConsumptionBill, BillItem, ReceptionSheet, ReceptionItem, DraftBill, DraftBillItem, DraftReception, DraftReceptionItem
+from models import Product, Location, ProductStock, ConsumptionBill, BillItem, ReceptionSheet, ReceptionItem, DraftBill, DraftBillItem, DraftReception, DraftReceptionItem
+from stock import (current_site, site_filter, get_or_create_location, stock_at, pick_location,
+                   stock_by_product, pick_location_from,
+                   apply_stock_delta, set_stock, stocked_outside, low_stock_products, site_products, count_products,
+                   backfill_product_stock)
+from archive import PAGE_SIZE, setup_retention, run_retention, archive_cutoff, document_page, find_document, forget_product
+from catalog_cache import product_cache, ensure_catalog_version, bump_catalog_version
+from catalog_payload import catalog_payloads
+from events import publish, stock_levels, publish_stock_crossings, sse_stream
+from reports import REPORT_YEARS, record_document, rebuild_rollups, month_range, monthly_summary_workbook
+from lines import HISTORY_PAGE_SIZE, MOVEMENT_KINDS, current_version, bill_lines, reception_lines, draft_session_items, product_movements
+from migrations import run_migrations
+from edge_sync import journal_document, journal_product, journal_stock_delta, apply_batch, catalog_rows, sync_once, sync_loop
+from stress import run_stress
+from idempotency import DuplicateRequest, session_scope, request_key, find_key, claim_key, remember, stored_body, replay, expire_keys
+from api import api, gzip_json
+from quantities import ensure_units, quantity_error
+import stock_math
+
+app.register_blueprint(api)
 
 def init_db():
     """Initialize database tables"""
     with app.app_context():
-        # Create all tables
         db.create_all()
+        run_migrations()
+        setup_retention()
+        backfill_product_stock(current_site())
+        ensure_catalog_version()
+        ensure_units()
+        db.session.commit()
 
 @app.route('/')
 def index():
     """Dashboard with low stock alerts and recent activity"""
+    site = current_site()
+    location_code = request.args.get('location', '')
+    
     # Get low stock products
-    low_stock_products = Product.query.filter(Product.quantity <= Product.min_stock).order_by(Product.quantity.asc()).all()
+    low_stock = low_stock_products(site, location_code)
     
     # Get total products count
-    total_products = Product.query.count()
+    total_products = count_products(site, location_code)
     
-    # Get recent consumption bills
-    recent_bills = ConsumptionBill.query.order_by(ConsumptionBill.bill_date.desc()).limit(5).all()
+    # Get recent consumption bills (bounded to the hot window so only recent partitions are read)
+    hot_since = archive_cutoff()
+    recent_bills = site_filter(ConsumptionBill.query, site, ConsumptionBill.site).filter(ConsumptionBill.bill_date >= hot_since).order_by(ConsumptionBill.bill_date.desc()).limit(5).all()
     
     # Get recent receptions
-    recent_receptions = ReceptionSheet.query.order_by(ReceptionSheet.reception_date.desc()).limit(5).all()
+    recent_receptions = site_filter(ReceptionSheet.query, site, ReceptionSheet.site).filter(ReceptionSheet.reception_date >= hot_since).order_by(ReceptionSheet.reception_date.desc()).limit(5).all()
     
     return render_template('index.html', 
-                         low_stock_products=low_stock_products,
+                         low_stock_products=low_stock,
                          total_products=total_products,
                          recent_bills=recent_bills,
-                         recent_receptions=recent_receptions)
+                         recent_receptions=recent_receptions,
+                         locations=site_filter(Location.query, site).order_by(Location.code).all(),
+                         location_code=location_code)
+
+@app.route('/events')
+def events():
+    """Server-sent events: finalized bills/receptions and min_stock crossings"""
+    return Response(sse_stream(current_site()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/products')
 def products():
     """Display all products with search functionality"""
+    site = current_site()
     search_query = request.args.get('search', '')
+    location_code = request.args.get('location', '')
+    
+    if site is not None or location_code:
+        query = site_products(site, location_code)
+    else:
+        query = Product.query.order_by(Product.name)
     
     if search_query:
-        products = Product.query.filter(
+        stocked_here = site_filter(
+            db.session.query(ProductStock.product_id)
+            .join(Location, Location.id == ProductStock.location_id)
+            .filter(Location.code.ilike(f'%{search_query}%')),
+            site
+        )
+        query = query.filter(
             (Product.code.ilike(f'%{search_query}%')) |
             (Product.name.ilike(f'%{search_query}%')) |
-            (Product.location.ilike(f'%{search_query}%'))
-        ).order_by(Product.name).all()
+            (Product.location.ilike(f'%{search_query}%')) |
+            (Product.id.in_(stocked_here))
+        )
+    
+    return render_template('products.html', products=query.all(), search_query=search_query,
+                           locations=site_filter(Location.query, site).order_by(Location.code).all(),
+                           location_code=location_code)
+
+@app.route('/products/add', methods=['GET', 'POST'])
+def add_product():
+    """Add new product"""
+    if request.method == 'POST':
+        code = request.form['code'].strip()
+        name = request.form['name'].strip()
+        unit = request.form['unit'].strip()
+        quantity = float(request.form['quantity'])
+        location = request.form['location'].strip()
+        min_stock = float(request.form['min_stock'])
+        
+        error = quantity_error(quantity, unit) or quantity_error(min_stock, unit)
+        if error:
+            flash(error, 'error')
+            return render_template('products.html', action='add')
+        
+        try:
+            product = Product(code=code, name=name, unit=unit, quantity=0.0, location=location, min_stock=min_stock)
+            db.session.add(product)
+            db.session.flush()
+            current_version(product)
+            stock_location = get_or_create_location(location, current_site())
+            apply_stock_delta(product.id, stock_location.id, quantity)
+            journal_product(product)
+            journal_stock_delta(product, stock_location, quantity)
+            bump_catalog_version()
+            db.session.commit()
+            flash('Produsul a fost adăugat cu succes!', 'success')
+            return redirect(url_for('products'))
+        except IntegrityError:
+            db.session.rollback()
+            flash('Codul produsului există deja!', 'error')
+    
+    return render_template('products.html', action='add')
+
+@app.route('/products/edit/<int:product_id>', methods=['GET', 'POST'])
+def edit_product(product_id):
+    """Edit existing product"""
+    product = db.session.get(Product, product_id)
+    
+    if not product:
+        flash('Produsul nu a fost găsit!', 'error')
+        return redirect(url_for('products'))
+    
+    if request.method == 'POST':
+        quantity = float(request.form['quantity'])
+        location = request.form['location'].strip()
+        unit = request.form['unit'].strip()
+        min_stock = float(request.form['min_stock'])
+        
+        error = quantity_error(quantity, unit) or quantity_error(min_stock, unit)
+        if error:
+            flash(error, 'error')
+            return render_template('products.html', action='edit', product=product)
+        
+        try:
+            levels = stock_levels([product.id], current_site())
+            previous_code = product.code
+            stock_location = get_or_create_location(location, current_site())
+            delta = set_stock(product, quantity, stock_location, current_site())
+            product.code = request.form['code'].strip()
+            product.name = request.form['name'].strip()
+            product.unit = unit
+            product.location = location
+            product.min_stock = min_stock
+            db.session.flush()
+            current_version(product)
+            journal_product(product, previous_code)
+            journal_stock_delta(product, stock_location, delta)
+            publish_stock_crossings(levels, current_site())
+            bump_catalog_version()
+            db.session.commit()
+            flash('Produsul a fost actualizat cu succes!', 'success')
+            return redirect(url_for('products'))
+        except IntegrityError:
+            db.session.rollback()
+            flash('Codul produsului există deja!', 'error')
+    
+    return render_template('products.html', action='edit', product=product)
+
+@app.route('/products/history')
+def product_history():
+    """Consumption and reception lines of one product over a date range, newest first (JSON)"""
+    code = request.args.get('code', '').strip()
+    product = product_cache.get(code)
+    
+    if not product:
+        return jsonify({'error': 'Produsul nu a fost găsit'}), 404
+    
+    try:
+        # start and end are days; end is inclusive
+        start = datetime.fromisoformat(request.args['start']) if request.args.get('start') else None
+        end = datetime.fromisoformat(request.args['end']) + timedelta(days=1) if request.args.get('end') else None
+        cursor = None
+        if request.args.get('before'):
+            cursor = (datetime.fromisoformat(request.args['before']), request.args['before_kind'],
+                      int(request.args['before_id']))
+            if cursor[1] not in MOVEMENT_KINDS:
+                raise ValueError(cursor[1])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Intervalul selectat nu este valid'}), 400
+    
+    movements = product_movements(product.id, current_site(), start, end, cursor)
+    
+    next_page = None
+    if len(movements) == HISTORY_PAGE_SIZE:
+        last = movements[-1]
+        next_page = {'code': code, 'start': request.args.get('start', ''), 'end': request.args.get('end', ''),
+                     'before': last.date.isoformat(), 'before_kind': last.kind, 'before_id': last.id}
+    
+    return jsonify({
+        'product': product._asdict(),
+        'movements': [{
+            'id': movement.id,
+            'date': movement.date.isoformat(),
+            'kind': movement.kind,
+            'document_id': movement.document_id,
+            'quantity': movement.quantity,
+            'party': movement.party,
+            'location': movement.location
+        } for movement in movements],
+        'next_page': next_page
+    })
+
+@app.route('/products/delete/<int:product_id>')
+def delete_product(product_id):
+    """Delete product"""
+    product = db.session.get(Product, product_id)
+    if product and stocked_outside(product.id, current_site()):
+        # Deleting cascades to every site's stock rows; only an unscoped instance may do that
+        flash('Produsul are stoc în alte site-uri și nu poate fi șters de aici!', 'error')
+        return redirect(url_for('products'))
+    if product:
+        forget_product(product.id)
+        db.session.delete(product)
+        bump_catalog_version()
+        db.session.commit()
+    
+    flash('Produsul a fost șters cu succes!', 'success')
+    return redirect(url_for('products'))
+
+def page_cursor():
+    """(date, id) keyset cursor from the before/before_id query arguments"""
+    before = request.args.get('before')
+    if not before:
+        return None, None
+    return datetime.fromisoformat(before), request.args.get('before_id', type=int)
+
+def next_page_args(rows, date_column):
+    """Query arguments for the page after rows, None on the last page"""
+    if len(rows) < PAGE_SIZE:
+        return None
+    last = rows[-1]
+    return {'before': getattr(last, date_column).isoformat(), 'before_id': last.id}
+
+@app.route('/consumption_bills')
+def consumption_bills():
+    """Display consumption bills, newest first, one page at a time"""
+    before, before_id = page_cursor()
+    bills = document_page('bill', current_site(), before, before_id)
+    
+    return render_template('consumption_bills.html', bills=bills, next_page=next_page_args(bills, 'bill_date'))
+
+def catalog_url():
+    """Versioned URL of the current product-picker payload"""
+    return url_for('catalog_products', v=catalog_payloads.current(current_site()).version)
+
+@app.route('/catalog/products.json')
+def catalog_products():
+    """Product-picker payload; a versioned URL never changes, so clients cache it for good"""
+    requested = request.args.get('v', type=int)
+    payload = catalog_payloads.current(current_site(), requested)
+    
+    if requested != payload.version:
+        return redirect(url_for('catalog_products', v=payload.version))
+    
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response = Response(payload.body, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(gzip.decompress(payload.body), mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = 31536000
+    response.cache_control.immutable = True
+    response.set_etag(payload.etag)
+    return response.make_conditional(request)
+
+@app.route('/consumption_bills/create')
+def create_consumption_bill():
+    """Create new consumption bill"""
+    # Load draft if exists
+    draft_data = load_draft_bill()
+    # Scope the page's idempotency keys before it can submit one
+    session_scope()
+    
+    return render_template('bill_create.html', catalog_url=catalog_url(), draft_data=draft_data)
+
+def document_item(product, quantity, location, item_number):
+    """Session representation of a bill/reception line"""
+    return {
+        'item_number': item_number,
+        'product_id': product.id,
+        'code': product.code,
+        'name': product.name,
+        'unit': product.unit,
+        'quantity': quantity,
+        'location': location.code,
+        'location_id': location.id
+    }
+
+@app.route('/consumption_bills/add_item', methods=['POST'])
+def add_bill_item():
+    """Add item to current bill (AJAX endpoint)"""
+    product_code = request.form['product_code']
+    quantity = float(request.form['quantity'])
+    
+    product = product_cache.get(product_code)
+    
+    if not product:
+        return jsonify({'error': 'Produsul nu a fost găsit'}), 400
+    
+    error = quantity_error(quantity, product.unit)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    location = pick_location(product, current_site(), request.form.get('location'))
+    if not location:
+        return jsonify({'error': 'Locația nu a fost găsită'}), 400
+    
+    if quantity > stock_at(product.id, location.id):
+        return jsonify({'error': 'Cantitatea solicitată depășește stocul disponibil'}), 400
+    
+    # Add to session
+    if 'bill_items' not in session:
+        session['bill_items'] = []
+    
+    item = document_item(product, quantity, location, len(session['bill_items']) + 1)
+    
+    session['bill_items'].append(item)
+    session.modified = True
+    
+    return jsonify({'success': True, 'item': item})
+
+# Upper bound on lines per batch request; scanner clients flush well below this
+MAX_BATCH_ITEMS = 200
+
+def add_items_batch(session_key, consumes_stock):
+    """Add a burst of scanned lines to the current document in one request.
+
+    Expects JSON {"items": [{"product_code", "quantity", "location"?}]}. All codes
+    are resolved with one IN query and all stock with one more. Lines for the same
+    product and location, in the batch or already on the document, are merged.
+    Returns one result per input line, so a bad scan doesn't reject the burst.
+    """
+    key = request_key()
+    done = find_key(session_key, key)
+    if done:
+        return replay_batch(done, session_key, key)
+    
+    payload = request.get_json(silent=True) or {}
+    lines = payload.get('items')
+    
+    if not isinstance(lines, list) or not lines:
+        return jsonify({'error': 'Nu există articole'}), 400
+    
+    if len(lines) > MAX_BATCH_ITEMS:
+        return jsonify({'error': f'Maxim {MAX_BATCH_ITEMS} articole pe cerere'}), 400
+    
+    try:
+        claimed = claim_key(session_key, key)
+    except DuplicateRequest as duplicate:
+        if duplicate.record:
+            return replay_batch(duplicate.record, session_key, key)
+        return jsonify({'error': 'Cererea este deja în curs de procesare'}), 409
+    
+    site = current_site()
+    codes = {str(line.get('product_code', '')).strip() for line in lines if isinstance(line, dict)}
+    products = product_cache.get_many(codes)
+    stock = stock_by_product([product.id for product in products.values()], site)
+    
+    items = session.get(session_key, [])
+    by_key = {(item.get('product_id'), item.get('location_id')): item for item in items}
+    results = []
+    # What the batch added per line, for a retry that arrives without this response's session
+    added = {}
+    
+    for index, line in enumerate(lines):
+        line = line if isinstance(line, dict) else {}
+        code = str(line.get('product_code', '')).strip()
+        result = {'index': index, 'product_code': code, 'success': False}
+        results.append(result)
+        
+        try:
+            quantity = float(line.get('quantity'))
+        except (TypeError, ValueError):
+            quantity = 0.0
+        if quantity <= 0:
+            result['error'] = 'Cantitate invalidă'
+            continue
+        
+        product = products.get(code)
+        if not product:
+            result['error'] = 'Produsul nu a fost găsit'
+            continue
+        
+        error = quantity_error(quantity, product.unit)
+        if error:
+            result['error'] = error
+            continue
+        
+        location_code = str(line.get('location') or '').strip()
+        rows = stock.get(product.id, [])
+        if location_code and not consumes_stock:
+            # Receptions may open a new location inside the site
+            location = get_or_create_location(location_code, site)
+        else:
+            location = pick_location_from(product, rows, site, location_code)
+        if not location:
+            result['error'] = 'Locația nu a fost găsită'
+            continue
+        
+        existing = by_key.get((product.id, location.id))
+        total = quantity + (existing['quantity'] if existing else 0.0)
+        available = next((held for held_at, held in rows if held_at.id == location.id), 0.0)
+        if consumes_stock and total > available:
+            result['error'] = 'Cantitatea solicitată depășește stocul disponibil'
+            continue
+        
+        if existing:
+            existing['quantity'] = total
+        else:
+            existing = document_item(product, quantity, location, len(items) + 1)
+            items.append(existing)
+            by_key[(product.id, location.id)] = existing
+        
+        result.update(success=True, quantity=quantity, item_number=existing['item_number'])
+        added.setdefault((product.id, location.id), {**existing, 'quantity': 0.0})['quantity'] += quantity
+    
+    # Persist any location opened on the way, and the response for retries with the same key
+    body = {'success': True, 'results': results, 'items': items}
+    remember(claimed, body={**body, 'added': list(added.values())})
+    db.session.commit()
+    
+    session[session_key] = items
+    mark_batch_applied(key)
+    
+    return jsonify(body)
+
+# Batch keys whose lines reached the session, most recent last; clients retry only their latest batch
+APPLIED_BATCHES_KEPT = 5
+
+def mark_batch_applied(key):
+    if key is None:
+        return
+    session['applied_batches'] = (session.get('applied_batches', []) + [key])[-APPLIED_BATCHES_KEPT:]
+    session.modified = True
+
+def replay_batch(record, session_key, key):
+    """Answer a retried batch with its original results and the document's current lines.
+
+    If the original response, and the session cookie it carried, never reached the
+    client, the batch's lines are added to the current lines again. Lines added or
+    removed since then are kept.
+    """
+    stored = stored_body(record)
+    items = session.get(session_key, [])
+    if key not in session.get('applied_batches', []):
+        by_key = {(item.get('product_id'), item.get('location_id')): item for item in items}
+        for line in stored['added']:
+            existing = by_key.get((line['product_id'], line['location_id']))
+            if existing:
+                existing['quantity'] += line['quantity']
+            else:
+                items.append({**line, 'item_number': len(items) + 1})
+        session[session_key] = items
+        mark_batch_applied(key)
+    return jsonify({'success': True, 'results': stored['results'], 'items': items})
+
+@app.route('/consumption_bills/add_items', methods=['POST'])
+def add_bill_items():
+    """Add a batch of scanned items to the current bill (AJAX endpoint)"""
+    return add_items_batch('bill_items', consumes_stock=True)
+
+@app.route('/consumption_bills/remove_item/<int:item_index>')
+def remove_bill_item(item_index):
+    """Remove item from current bill"""
+    if 'bill_items' in session and 0 <= item_index < len(session['bill_items']):
+        session['bill_items'].pop(item_index)
+        # Renumber items
+        for i, item in enumerate(session['bill_items']):
+            item['item_number'] = i + 1
+        session.modified = True
+        flash('Articolul a fost eliminat!', 'success')
+    
+    return redirect(url_for('create_consumption_bill'))
+
+def session_item_product(item):
+    """Product of a session line; lines saved before product ids were kept fall back to the code"""
+    if item.get('product_id'):
+        product = db.session.get(Product, item['product_id'])
+        if product is not None:
+            return product
+    return Product.query.filter_by(code=item['code']).one()
+
+def clear_drafts(draft_model, item_model, site):
+    """Delete a site's drafts and their items"""
+    draft_ids = db.session.query(draft_model.id).filter_by(site=site)
+    item_model.query.filter(item_model.draft_id.in_(draft_ids)).delete(synchronize_session=False)
+    draft_model.query.filter_by(site=site).delete(synchronize_session=False)
+
+@app.route('/consumption_bills/save_draft', methods=['POST'])
+def save_bill_draft():
+    """Save current bill as draft"""
+    site = current_site()
+    
+    # Clear this site's existing draft
+    clear_drafts(DraftBill, DraftBillItem, site)
+    
+    # Save new draft
+    draft = DraftBill(site=site,
+                      employee_name=request.form.get('employee_name', ''),
+                      employee_signature=request.form.get('employee_signature', ''))
+    
+    # Save draft items
+    for item in session.get('bill_items', []):
+        draft.items.append(DraftBillItem(
+            item_number=item['item_number'], product_id=session_item_product(item).id,
+            quantity=item['quantity'], location_id=item.get('location_id')))
+    
+    db.session.add(draft)
+    db.session.commit()
+    
+    flash('Bonul a fost salvat ca ciornă!', 'success')
+    return redirect(url_for('create_consumption_bill'))
+
+def resolve_item_location(item, product, site):
+    """Location of a session line, re-resolved for lines saved before locations existed"""
+    if item.get('location_id'):
+        location = db.session.get(Location, item['location_id'])
+        if location is not None and (site is None or location.site == site):
+            return location
+    return pick_location(product, site, item.get('location'))
+
+def replay_finalize(record, session_key, message):
+    """Answer a retried finalize with its original result, dropping the lines the retry carried"""
+    session.pop(session_key, None)
+    flash(message, 'success')
+    return replay(record)
+
+@app.route('/consumption_bills/finalize', methods=['POST'])
+def finalize_consumption_bill():
+    """Finalize consumption bill"""
+    # A retry of an already finalized bill gets the original result
+    done = find_key('bill_finalize', request_key())
+    if done:
+        return replay_finalize(done, 'bill_items', 'Bonul de consum a fost finalizat cu succes!')
+    
+    employee_name = request.form['employee_name'].strip()
+    employee_signature = request.form['employee_signature'].strip()
+    site = current_site()
+    
+    if not employee_name:
+        flash('Numele angajatului este obligatoriu!', 'error')
+        return redirect(url_for('create_consumption_bill'))
+    
+    if 'bill_items' not in session or not session['bill_items']:
+        flash('Nu există articole în bon!', 'error')
+        return redirect(url_for('create_consumption_bill'))
+    
+    try:
+        claimed = claim_key('bill_finalize', request_key())
+        
+        # Create bill
+        bill = ConsumptionBill(site=site, employee_name=employee_name,
+                               employee_signature=employee_signature, is_finished=True)
+        db.session.add(bill)
+        
+        products = [session_item_product(item) for item in session['bill_items']]
+        levels = stock_levels([product.id for product in products], site)
+        
+        # Add bill items and update stock
+        for item, product in zip(session['bill_items'], products):
+            location = resolve_item_location(item, product, site)
+            
+            bill.items.append(BillItem(
+                item_number=item['item_number'], product_id=product.id,
+                product_version_id=current_version(product).id,
+                quantity=item['quantity'], location_id=location.id))
+            
+            # Update product stock
+            apply_stock_delta(product.id, location.id, -item['quantity'])
+        
+        # Notify live dashboards once the transaction commits and add the lines to the daily rollups
+        db.session.flush()
+        publish('bill_finalized', site, id=bill.id, employee_name=employee_name,
+                bill_date=bill.bill_date, items=len(bill.items))
+        record_document('bill', bill)
+        journal_document('bill', bill)
+        publish_stock_crossings(levels, site)
+        bump_catalog_version()
+        
+        # Clear draft
+        clear_drafts(DraftBill, DraftBillItem, site)
+        
+        remember(claimed, bill.id, location=url_for('consumption_bills'))
+        db.session.commit()
+        
+        # Clear session
+        session.pop('bill_items', None)
+        
+        flash('Bonul de consum a fost finalizat cu succes!', 'success')
+        return redirect(url_for('consumption_bills'))
+        
+    except DuplicateRequest as duplicate:
+        if duplicate.record:
+            return replay_finalize(duplicate.record, 'bill_items', 'Bonul de consum a fost finalizat cu succes!')
+        flash('Bonul este deja în curs de finalizare!', 'error')
+        return redirect(url_for('create_consumption_bill'))
+        
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Eroare la finalizarea bonului: {str(e)}', 'error')
+        return redirect(url_for('create_consumption_bill'))
+
+def get_site_bill(bill_id):
+    """Bill by id from the live or archive tables, as (bill, archived); None if it belongs to another site"""
+    return find_document('bill', bill_id, current_site())
+
+@app.route('/consumption_bills/view/<int:bill_id>')
+def view_consumption_bill(bill_id):
+    """View consumption bill details"""
+    bill, archived = get_site_bill(bill_id)
+    
+    if not bill:
+        flash('Bonul nu a fost găsit!', 'error')
+        return redirect(url_for('consumption_bills'))
+    
+    items = bill_lines(bill_id, archived)
+    
+    return render_template('bill_create.html', bill=bill, items=items, view_mode=True)
+
+THIN_BORDER = Border(
+    top=Side(style='thin'),
+    bottom=Side(style='thin'),
+    left=Side(style='thin'),
+    right=Side(style='thin')
+)
+
+@app.route('/consumption_bills/export/<int:bill_id>')
+def export_consumption_bill(bill_id):
+    """Export consumption bill to Excel"""
+    bill, archived = get_site_bill(bill_id)
+    
+    if not bill:
+        flash('Bonul nu a fost găsit!', 'error')
+        return redirect(url_for('consumption_bills'))
+    
+    items = bill_lines(bill_id, archived)
+    
+    # Create Excel workbook
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = f"Bon Consum {bill_id}"
+    
+    # Header
+    ws['A1'] = 'BON DE CONSUM'
+    ws['A1'].font = Font(bold=True, size=16)
+    ws.merge_cells('A1:G1')
+    ws['A1'].alignment = Alignment(horizontal='center')
+    
+    # Bill info
+    ws['A3'] = f"Data: {bill.bill_date.strftime('%Y-%m-%d %H:%M')}"
+    ws['A4'] = f"Angajat: {bill.employee_name}"
+    ws['A5'] = f"Semnătura: {bill.employee_signature}"
+    
+    # Table header
+    headers = ['Nr.', 'Cod Produs', 'Denumire', 'U.M.', 'Cantitate', 'Locație']
+    for col, header in enumerate(headers, 1):
+        cell = ws.cell(row=7, column=col, value=header)
+        cell.font = Font(bold=True)
+        cell.border = THIN_BORDER
+    
+    # Table data
+    for row, item in enumerate(items, 8):
+        ws.cell(row=row, column=1, value=item.item_number)
+        ws.cell(row=row, column=2, value=item.product_code)
+        ws.cell(row=row, column=3, value=item.product_name)
+        ws.cell(row=row, column=4, value=item.unit)
+        ws.cell(row=row, column=5, value=item.quantity)
+        ws.cell(row=row, column=6, value=item.location)
+        
+        for col in range(1, 7):
+            ws.cell(row=row, column=col).border = THIN_BORDER
+    
+    # Adjust column widths
+    for col in range(1, 7):
+        ws.column_dimensions[get_column_letter(col)].width = 15
+    
+    # Save to memory
+    output = io.BytesIO()
+    wb.save(output)
+    output.seek(0)
+    
+    return send_file(
+        output,
+        as_attachment=True,
+        download_name=f'bon_consum_{bill_id}.xlsx',
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    )
+
+@app.route('/reception')
+def reception():
+    """Display reception sheets, newest first, one page at a time"""
+    before, before_id = page_cursor()
+    receptions = document_page('reception', current_site(), before, before_id)
+    
+    return render_template('reception.html', receptions=receptions, next_page=next_page_args(receptions, 'reception_date'))
+
+def get_site_reception(reception_id):
+    """Reception by id from the live or archive tables, as (reception, archived); None if it belongs to another site"""
+    return find_document('reception', reception_id, current_site())
+
+@app.route('/reception/view/<int:reception_id>')
+def view_reception(reception_id):
+    """View reception details"""
+    reception, archived = get_site_reception(reception_id)
+    
+    if not reception:
+        return jsonify({'error': 'Recepția nu a fost găsită'}), 404
+    
+    items = reception_lines(reception_id, archived)
+    
+    # Return JSON for AJAX request
+    return jsonify({
+        'reception': {
+            'id': reception.id,
+            'date': reception.reception_date.isoformat(),
+            'supplier': reception.supplier,
+            'document_number': reception.document_number,
+            'notes': reception.notes,
+            'is_finished': reception.is_finished
+        },
+        'items': [{
+            'id': item.id,
+            'reception_id': item.reception_id,
+            'item_number': item.item_number,
+            'product_id': item.product_id,
+            'product_code': item.product_code,
+            'product_name': item.product_name,
+            'unit': item.unit,
+            'quantity': item.quantity,
+            'location': item.location,
+            'entry_date': item.entry_date.isoformat()
+        } for item in items]
+    })
+
+@app.route('/reception/export/<int:reception_id>')
+def export_reception(reception_id):
+    """Export reception to Excel"""
+    reception, archived = get_site_reception(reception_id)
+    
+    if not reception:
+        flash('Recepția nu a fost găsită!', 'error')
+        return redirect(url_for('reception'))
+    
+    items = reception_lines(reception_id, archived)
+    
+    # Create Excel workbook
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = f"Receptie {reception_id}"
+    
+    # Header
+    ws['A1'] = 'FIȘĂ DE RECEPȚIE'
+    ws['A1'].font = Font(bold=True, size=16)
+    ws.merge_cells('A1:G1')
+    ws['A1'].alignment = Alignment(horizontal='center')
+    
+    # Reception info
+    ws['A3'] = f"Data: {reception.reception_date.strftime('%Y-%m-%d %H:%M')}"
+    ws['A4'] = f"Furnizor: {reception.supplier}"
+    ws['A5'] = f"Nr. Document: {reception.document_number or '-'}"
+    ws['A6'] = f"Observații: {reception.notes or '-'}"
+    
+    # Table header
+    headers = ['Nr.', 'Cod Produs', 'Denumire', 'U.M.', 'Cantitate', 'Locație', 'Data Intrare']
+    for col, header in enumerate(headers, 1):
+        cell = ws.cell(row=8, column=col, value=header)
+        cell.font = Font(bold=True)
+        cell.border = THIN_BORDER
+    
+    # Table data
+    for row, item in enumerate(items, 9):
+        ws.cell(row=row, column=1, value=item.item_number)
+        ws.cell(row=row, column=2, value=item.product_code)
+        ws.cell(row=row, column=3, value=item.product_name)
+        ws.cell(row=row, column=4, value=item.unit)
+        ws.cell(row=row, column=5, value=item.quantity)
+        ws.cell(row=row, column=6, value=item.location or '-')
+        ws.cell(row=row, column=7, value=item.entry_date.strftime('%Y-%m-%d') if item.entry_date else '-')
+        
+        # Add borders
+        for col in range(1, 8):
+            ws.cell(row=row, column=col).border = THIN_BORDER
+    
+    # Auto-adjust column widths
+    for col in range(1, 8):
+        ws.column_dimensions[get_column_letter(col)].width = 15
+    
+    # Save to memory
+    output = io.BytesIO()
+    wb.save(output)
+    output.seek(0)
+    
+    return send_file(
+        output,
+        as_attachment=True,
+        download_name=f'receptie_{reception_id}_{datetime.now().strftime("%Y%m%d")}.xlsx',
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    )
+
+@app.route('/reception/save_draft', methods=['POST'])
+def save_reception_draft():
+    """Save current reception as draft"""
+    site = current_site()
+    
+    # Clear this site's existing draft
+    clear_drafts(DraftReception, DraftReceptionItem, site)
+    
+    # Save new draft
+    draft = DraftReception(site=site,
+                           supplier=request.form.get('supplier', ''),
+                           document_number=request.form.get('document_number', ''),
+                           notes=request.form.get('notes', ''))
+    
+    # Save draft items
+    for item in session.get('reception_items', []):
+        draft.items.append(DraftReceptionItem(
+            item_number=item['item_number'], product_id=session_item_product(item).id,
+            quantity=item['quantity'], location_id=item.get('location_id')))
+    
+    db.session.add(draft)
+    db.session.commit()
+    
+    flash('Recepția a fost salvată ca ciornă!', 'success')
+    return redirect(url_for('create_reception'))
+
+@app.route('/reception/create')
+def create_reception():
+    """Create new reception sheet"""
+    # Load draft if exists
+    draft_data = load_draft_reception()
+    # Scope the page's idempotency keys before it can submit one
+    session_scope()
+    
+    return render_template('reception_create.html', catalog_url=catalog_url(), draft_data=draft_data)
+
+@app.route('/reception/add_item', methods=['POST'])
+def add_reception_item():
+    """Add item to current reception"""
+    product_code = request.form['product_code']
+    quantity = float(request.form['quantity'])
+    site = current_site()
+    
+    product = product_cache.get(product_code)
+    
+    if not product:
+        return jsonify({'error': 'Produsul nu a fost găsit'}), 400
+    
+    error = quantity_error(quantity, product.unit)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    # Receptions may open a new location inside the site
+    location_code = request.form.get('location', '').strip()
+    if location_code:
+        location = get_or_create_location(location_code, site)
+    else:
+        location = pick_location(product, site)
+    db.session.commit()
+    
+    # Add to session
+    if 'reception_items' not in session:
+        session['reception_items'] = []
+    
+    item = document_item(product, quantity, location, len(session['reception_items']) + 1)
+    
+    session['reception_items'].append(item)
+    session.modified = True
+    
+    return jsonify({'success': True, 'item': item})
+
+@app.route('/reception/add_items', methods=['POST'])
+def add_reception_items():
+    """Add a batch of scanned items to the current reception (AJAX endpoint)"""
+    return add_items_batch('reception_items', consumes_stock=False)
+
+@app.route('/reception/remove_item/<int:item_index>')
+def remove_reception_item(item_index):
+    """Remove item from current reception"""
+    if 'reception_items' in session and 0 <= item_index < len(session['reception_items']):
+        session['reception_items'].pop(item_index)
+        # Renumber items
+        for i, item in enumerate(session['reception_items']):
+            item['item_number'] = i + 1
+        session.modified = True
+        flash('Articolul a fost eliminat!', 'success')
+    
+    return redirect(url_for('create_reception'))
+
+@app.route('/reception/finalize', methods=['POST'])
+def finalize_reception():
+    """Finalize reception sheet"""
+    # A retry of an already finalized reception gets the original result
+    done = find_key('reception_finalize', request_key())
+    if done:
+        return replay_finalize(done, 'reception_items', 'Fișa de recepție a fost finalizată cu succes!')
+    
+    supplier = request.form['supplier'].strip()
+    document_number = request.form['document_number'].strip()
+    notes = request.form['notes'].strip()
+    site = current_site()
+    
+    if not supplier:
+        flash('Furnizorul este obligatoriu!', 'error')
+        return redirect(url_for('create_reception'))
+    
+    if 'reception_items' not in session or not session['reception_items']:
+        flash('Nu există articole în recepție!', 'error')
+        return redirect(url_for('create_reception'))
+    
+    try:
+        claimed = claim_key('reception_finalize', request_key())
+        
+        # Create reception
+        reception = ReceptionSheet(site=site, supplier=supplier, document_number=document_number,
+                                   notes=notes, is_finished=True)
+        db.session.add(reception)
+        
+        products = [session_item_product(item) for item in session['reception_items']]
+        levels = stock_levels([product.id for product in products], site)
+        
+        # Add reception items and update stock
+        for item, product in zip(session['reception_items'], products):
+            location = resolve_item_location(item, product, site)
+            
+            reception.items.append(ReceptionItem(
+                item_number=item['item_number'], product_id=product.id,
+                product_version_id=current_version(product).id,
+                quantity=item['quantity'], location_id=location.id, entry_date=datetime.utcnow()))
+            
+            # Update product stock
+            apply_stock_delta(product.id, location.id, item['quantity'])
+        
+        # Notify live dashboards once the transaction commits and add the lines to the daily rollups
+        db.session.flush()
+        publish('reception_finalized', site, id=reception.id, supplier=supplier,
+                reception_date=reception.reception_date, items=len(reception.items))
+        record_document('reception', reception)
+        journal_document('reception', reception)
+        publish_stock_crossings(levels, site)
+        bump_catalog_version()
+        
+        # Clear draft
+        clear_drafts(DraftReception, DraftReceptionItem, site)
+        
+        remember(claimed, reception.id, location=url_for('reception'))
+        db.session.commit()
+        
+        # Clear session
+        session.pop('reception_items', None)
+        
+        flash('Fișa de recepție a fost finalizată cu succes!', 'success')
+        return redirect(url_for('reception'))
+        
+    except DuplicateRequest as duplicate:
+        if duplicate.record:
+            return replay_finalize(duplicate.record, 'reception_items', 'Fișa de recepție a fost finalizată cu succes!')
+        flash('Recepția este deja în curs de finalizare!', 'error')
+        return redirect(url_for('create_reception'))
+        
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Eroare la finalizarea recepției: {str(e)}', 'error')
+        return redirect(url_for('create_reception'))
+
+@app.route('/reports/monthly')
+def monthly_report():
+    """Export the monthly consumption/reception summary to Excel"""
+    today = datetime.utcnow()
+    year = request.args.get('year', today.year, type=int)
+    month = request.args.get('month', today.month, type=int)
+    
+    if year not in REPORT_YEARS:
+        flash('Anul selectat nu este valid!', 'error')
+        return redirect(url_for('index'))
+    
+    if not 1 <= month <= 12:
+        flash('Luna selectată nu este validă!', 'error')
+        return redirect(url_for('index'))
+    
+    output = monthly_summary_workbook(year, month, current_site())
+    
+    return send_file(
+        output,
+        as_attachment=True,
+        download_name=f'raport_lunar_{year}_{month:02d}.xlsx',
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    )
+
+@app.route('/stats/product_cache')
+def product_cache_stats():
+    """Hit ratio and size of this worker's product lookup cache"""
+    return jsonify(product_cache.stats())
+
+def sync_authorized():
+    token = app.config['SYNC_TOKEN']
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    return bool(token) and hmac.compare_digest(supplied, token)
+
+@app.route('/sync/push', methods=['POST'])
+def sync_push():
+    """Replay a batch of journal entries pushed by an edge node"""
+    if not sync_authorized():
+        return jsonify({'error': 'Acces neautorizat'}), 403
+    
+    body = request.get_data()
+    if request.headers.get('Content-Encoding') == 'gzip':
+        body = gzip.decompress(body)
+    
+    try:
+        result = apply_batch(json.loads(body))
+    except Exception as e:
+        db.session.rollback()
+        app.logger.exception('Sync batch failed')
+        return jsonify({'error': f'Eroare la aplicarea lotului: {str(e)}'}), 500
+    
+    return gzip_json(result)
+
+@app.route('/sync/catalog')
+def sync_catalog():
+    """Products changed since an edge node's last pull, with their stock in its site"""
+    if not sync_authorized():
+        return jsonify({'error': 'Acces neautorizat'}), 403
+    
+    rows = catalog_rows(request.args.get('site') or None, request.args.get('since', ''),
+                        request.args.get('after_id', 0, type=int),
+                        min(request.args.get('limit', 1000, type=int), 10000))
+    return gzip_json({'products': rows})
+
+@app.cli.command('sync')
+@click.option('--loop', is_flag=True, help='Keep syncing every EDGE_SYNC_INTERVAL seconds')
+def sync_command(loop):
+    """Push the edge journal to CENTRAL_URL and pull catalog changes"""
+    if not app.config['EDGE_MODE'] or not app.config['CENTRAL_URL']:
+        raise click.ClickException('Sync needs EDGE_MODE=1 and CENTRAL_URL')
+    if loop:
+        sync_loop(app.config['EDGE_SYNC_INTERVAL'])
+    pushed, pulled = sync_once()
+    print(f'{pushed} journal entries pushed, {pulled} products pulled')
+
+@app.cli.command('stress')
+@click.option('--workers', default=4, show_default=True, help='Concurrent worker processes')
+@click.option('--iterations', default=50, show_default=True, help='Documents finalized per worker')
+@click.option('--products', default=20, show_default=True, help='STRESS-* products competing for locks')
+@click.option('--max-lines', default=5, show_default=True, help='Most lines per document')
+@click.option('--reception-ratio', default=0.4, show_default=True, help='Share of receptions among documents')
+@click.option('--seed', type=int, default=None, help='Repeat a previous run')
+@click.option('--yes', is_flag=True, help='Do not ask before writing test documents')
+def stress_command(workers, iterations, products, max_lines, reception_ratio, seed, yes):
+    """Fire concurrent finalizes and check quantity == initial + receptions - consumption"""
+    if not yes:
+        click.confirm(f'Write test bills and receptions to {db.engine.url.render_as_string()}?', abort=True)
+    report = run_stress(workers, iterations, products, max_lines, reception_ratio, seed=seed)
+    for key, value in report.items():
+        if key != 'violations':
+            print(f'{key}: {value}')
+    if report['violations']:
+        raise click.ClickException('Stock invariant violated:\n' + '\n'.join(report['violations']))
+    print('Stock invariant holds')
+
+@app.cli.command('expire-idempotency-keys')
+def expire_idempotency_keys_command():
+    """Delete idempotency keys older than IDEMPOTENCY_KEY_TTL_HOURS"""
+    print(f'{expire_keys()} idempotency keys expired')
+
+@app.cli.command('archive')
+def archive_command():
+    """Move finished documents past ARCHIVE_AFTER_DAYS to cold storage"""
+    for kind, moved in run_retention().items():
+        print(f'{kind}: {moved} archived')
+
+@app.cli.command('rebuild-rollups')
+@click.option('--year', type=click.IntRange(REPORT_YEARS.start, REPORT_YEARS.stop - 1), required=True)
+@click.option('--month', type=click.IntRange(1, 12), default=None, help='Whole year when omitted')
+def rebuild_rollups_command(year, month):
+    """Recompute the daily report rollups from bill and reception lines"""
+    if month:
+        start, end = month_range(year, month)
     else:
-        products = Product.query.order_by(Product.name).all()
+        start, end = month_range(year, 1)[0], month_range(year + 1, 1)[0]
+    rebuild_rollups(start, end)
+    print(f'Rollups rebuilt for {start} - {end}')
+
+@app.cli.command('reconcile')
+def reconcile_command():
+    """Check product totals, location stock and report rollups against each other"""
+    problems = stock_math.reconcile()
+    for problem in problems:
+        print(f"{problem['code']}: {problem['check']}: {problem['actual']} != {problem['expected']}")
+    if problems:
+        raise click.ClickException(f'{len(problems)} discrepancies (rollups can be recomputed with rebuild-rollups)')
+    print('Stock totals and rollups agree')
+
+@app.cli.command('stock-movements')
+@click.option('--year', type=click.IntRange(REPORT_YEARS.start, REPORT_YEARS.stop - 1), required=True)
+@click.option('--month', type=click.IntRange(1, 12), required=True)
+def stock_movements_command(year, month):
+    """Received, consumed and net quantity per product over a month"""
+    start, end = month_range(year, month)
+    print('code\treceived\tconsumed\tnet')
+    for code, received, consumed, net in stock_math.movement_totals(start, end, current_site()):
+        print(f'{code}\t{received:g}\t{consumed:g}\t{net:g}')
+
+@app.cli.command('low-stock')
+def low_stock_command():
+    """Products at or below their minimum stock in this site"""
+    print('code\tquantity\tmin_stock')
+    for code, quantity, min_stock in stock_math.low_stock(current_site()):
+        print(f'{code}\t{quantity:g}\t{min_stock:g}')
+
+def load_draft_bill():
+    """Load draft bill data"""
+    draft = DraftBill.query.filter_by(site=current_site()).order_by(DraftBill.last_updated.desc()).first()
+    
+    if not draft:
+        return None
+    
+    # Convert to session format
+    session['bill_items'] = draft_session_items(DraftBillItem, draft.id)
     
-    return render_template('products.html', products=products, search_query=search_query)
-@app.before_first_request
-def create_tables():
-    db.create_all()
+    return {
+        'employee_name': draft.employee_name,
+        'employee_signature': draft.employee_signature
+    }
+
+def load_draft_reception():
+    """Load draft reception data"""
+    draft = DraftReception.query.filter_by(site=current_site()).order_by(DraftReception.last_updated.desc()).first()
+    
+    if not draft:
+        return None
+    
+    # Convert to session format
+    session['reception_items'] = draft_session_items(DraftReceptionItem, draft.id)
+    
+    return {
+        'supplier': draft.supplier,
+        'document_number': draft.document_number,
+        'notes': draft.notes
+    }
+
+# Create and migrate tables on startup (replaces the removed before_first_request hook)
+init_db()
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5000, debug=True)
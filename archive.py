@@ -0,0 +1,240 @@
+"""Retention for consumption bills and reception sheets.
+
+On PostgreSQL the document tables are range-partitioned by month, so old data
+stays in place and date-bounded queries only touch recent partitions. Other
+databases (SQLite) move finished documents older than ARCHIVE_AFTER_DAYS, with
+their lines, into *_archive tables. The read helpers below look in both places,
+so list, view and export routes don't need to know where a document lives.
+"""
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, Index, MetaData, Table, and_, func, inspect, or_, select, text
+
+from app import app, db
+from models import ConsumptionBill, BillItem, ReceptionSheet, ReceptionItem
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 100
+ARCHIVE_BATCH_SIZE = 500
+PARTITION_MONTHS_AHEAD = 3
+
+# Created only where partitioning is not available
+archive_metadata = MetaData()
+
+
+def _archive_copy(table, *indexes):
+    """Archive twin of a live table: same columns, no foreign keys"""
+    columns = [Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable)
+               for column in table.columns]
+    return Table(f'{table.name}_archive', archive_metadata, *columns, *indexes)
+
+
+bills_archive = _archive_copy(
+    ConsumptionBill.__table__,
+    Index('ix_consumption_bills_archive_site_date', 'site', 'bill_date'),
+    Index('ix_consumption_bills_archive_date', 'bill_date', 'id'))
+bill_items_archive = _archive_copy(
+    BillItem.__table__,
+    Index('ix_bill_items_archive_bill', 'bill_id'),
+    Index('ix_bill_items_archive_product_date', 'product_id', 'entry_date', 'id'))
+receptions_archive = _archive_copy(
+    ReceptionSheet.__table__,
+    Index('ix_reception_sheets_archive_site_date', 'site', 'reception_date'),
+    Index('ix_reception_sheets_archive_date', 'reception_date', 'id'))
+reception_items_archive = _archive_copy(
+    ReceptionItem.__table__,
+    Index('ix_reception_items_archive_reception', 'reception_id'),
+    Index('ix_reception_items_archive_product_date', 'product_id', 'entry_date', 'id'))
+
+# kind -> (live documents, archived documents, date column, live items, archived items, item FK)
+DOCUMENTS = {
+    'bill': (ConsumptionBill.__table__, bills_archive, 'bill_date',
+             BillItem.__table__, bill_items_archive, 'bill_id'),
+    'reception': (ReceptionSheet.__table__, receptions_archive, 'reception_date',
+                  ReceptionItem.__table__, reception_items_archive, 'reception_id'),
+}
+
+
+def is_postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def archive_cutoff():
+    """Documents dated before this are archived (or live in cold partitions)"""
+    return datetime.utcnow() - timedelta(days=app.config['ARCHIVE_AFTER_DAYS'])
+
+
+def _month_start(moment):
+    return datetime(moment.year, moment.month, 1)
+
+
+def _next_month(moment):
+    return datetime(moment.year + moment.month // 12, moment.month % 12 + 1, 1)
+
+
+def ensure_month_partitions(table, start, months_ahead=PARTITION_MONTHS_AHEAD):
+    """Create monthly partitions of a partitioned table from start until a few months ahead"""
+    month = _month_start(start)
+    last = _month_start(datetime.utcnow())
+    for _ in range(months_ahead):
+        last = _next_month(last)
+    while month <= last:
+        upper = _next_month(month)
+        db.session.execute(text(
+            f'CREATE TABLE IF NOT EXISTS {table}_y{month:%Y}m{month:%m} PARTITION OF {table} '
+            f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{upper:%Y-%m-%d}')"
+        ))
+        month = upper
+
+
+def _is_partitioned(table):
+    return db.session.execute(text(
+        'SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = :table'
+    ), {'table': table}).first() is not None
+
+
+def _partition_table(documents, date_column, items):
+    """Rebuild a plain document table as a table partitioned by month on its date"""
+    name = documents.name
+    logger.info('Partitioning %s by month on %s', name, date_column)
+
+    # A partitioned table can't back a foreign key on id alone; lines keep the id unchecked
+    for foreign_key in inspect(db.engine).get_foreign_keys(items.name):
+        if foreign_key['referred_table'] == name and foreign_key.get('name'):
+            db.session.execute(text(f'ALTER TABLE {items.name} DROP CONSTRAINT {foreign_key["name"]}'))
+
+    db.session.execute(text(f'ALTER TABLE {name} RENAME TO {name}_unpartitioned'))
+    db.session.execute(text(
+        f'CREATE TABLE {name} (LIKE {name}_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE ({date_column})'
+    ))
+    db.session.execute(text(f'ALTER TABLE {name} ADD PRIMARY KEY (id, {date_column})'))
+    db.session.execute(text(f'CREATE TABLE {name}_default PARTITION OF {name} DEFAULT'))
+
+    oldest = db.session.execute(text(f'SELECT MIN({date_column}) FROM {name}_unpartitioned')).scalar()
+    ensure_month_partitions(name, oldest or datetime.utcnow())
+
+    db.session.execute(text(f'INSERT INTO {name} SELECT * FROM {name}_unpartitioned'))
+    db.session.execute(text(f'ALTER SEQUENCE IF EXISTS {name}_id_seq OWNED BY {name}.id'))
+    db.session.execute(text(f'DROP TABLE {name}_unpartitioned'))
+
+    # Indexes declared on the model are recreated on the parent and cascade to partitions
+    for index in documents.indexes:
+        index.create(db.session.connection())
+
+
+def setup_retention():
+    """Prepare partitions (PostgreSQL) or archive tables (other databases)"""
+    if is_postgres():
+        for documents, _, date_column, items, _, _ in DOCUMENTS.values():
+            if _is_partitioned(documents.name):
+                ensure_month_partitions(documents.name, datetime.utcnow())
+            else:
+                _partition_table(documents, date_column, items)
+        db.session.commit()
+    else:
+        archive_metadata.create_all(db.engine)
+        # create_all skips indexes of archive tables that already exist
+        for table in archive_metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(db.engine, checkfirst=True)
+
+
+def forget_product(product_id):
+    """Unlink archived lines from a product being deleted, as ON DELETE SET NULL does for live lines"""
+    if is_postgres():
+        return
+    for _, _, _, _, archived_items, _ in DOCUMENTS.values():
+        if inspect(db.engine).has_table(archived_items.name):
+            db.session.execute(archived_items.update()
+                               .where(archived_items.c.product_id == product_id).values(product_id=None))
+
+
+def archive_documents(kind, cutoff=None, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move finished documents older than the cutoff, with their lines, to the archive tables"""
+    if is_postgres():
+        return 0
+
+    documents, archived, date_column, items, archived_items, item_fk = DOCUMENTS[kind]
+    cutoff = cutoff or archive_cutoff()
+    document_columns = [column.name for column in documents.columns]
+    item_columns = [column.name for column in items.columns]
+    moved = 0
+
+    # SQLite reuses the highest rowid once it is deleted; keeping the newest row
+    # live stops a new document from taking an archived document's id
+    newest_id = db.session.execute(select(func.max(documents.c.id))).scalar()
+    if newest_id is None:
+        return 0
+
+    while True:
+        ids = db.session.execute(
+            select(documents.c.id)
+            .where(documents.c[date_column] < cutoff, documents.c.is_finished.is_(True),
+                   documents.c.id < newest_id)
+            .order_by(documents.c.id)
+            .limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            break
+
+        db.session.execute(archived.insert().from_select(
+            document_columns, select(*[documents.c[name] for name in document_columns]).where(documents.c.id.in_(ids))))
+        db.session.execute(archived_items.insert().from_select(
+            item_columns, select(*[items.c[name] for name in item_columns]).where(items.c[item_fk].in_(ids))))
+        db.session.execute(items.delete().where(items.c[item_fk].in_(ids)))
+        db.session.execute(documents.delete().where(documents.c.id.in_(ids)))
+        db.session.commit()
+        moved += len(ids)
+
+    if moved:
+        logger.info('Archived %d %s documents older than %s', moved, kind, cutoff)
+    return moved
+
+
+def run_retention():
+    """Apply retention to all document kinds"""
+    setup_retention()
+    return {kind: archive_documents(kind) for kind in DOCUMENTS}
+
+
+def _page_query(table, date_column, site, before, before_id, limit):
+    query = select(table).order_by(table.c[date_column].desc(), table.c.id.desc()).limit(limit)
+    if site is not None:
+        query = query.where(table.c.site == site)
+    if before is not None:
+        query = query.where(or_(
+            table.c[date_column] < before,
+            and_(table.c[date_column] == before, table.c.id < before_id)))
+    return query
+
+
+def document_page(kind, site=None, before=None, before_id=None, limit=PAGE_SIZE):
+    """Newest documents older than the (date, id) cursor, live ones first, then the archive"""
+    documents, archived, date_column, _, _, _ = DOCUMENTS[kind]
+    rows = db.session.execute(_page_query(documents, date_column, site, before, before_id, limit)).all()
+    if len(rows) < limit and not is_postgres():
+        rows += db.session.execute(
+            _page_query(archived, date_column, site, before, before_id, limit - len(rows))).all()
+    return rows
+
+
+def find_document(kind, document_id, site=None):
+    """Document by id from the live or archive table, as (row, archived); (None, False) if missing"""
+    documents, archived, _, _, _, _ = DOCUMENTS[kind]
+    tables = [(documents, False)] if is_postgres() else [(documents, False), (archived, True)]
+    for table, is_archived in tables:
+        query = select(table).where(table.c.id == document_id)
+        if site is not None:
+            query = query.where(table.c.site == site)
+        row = db.session.execute(query).first()
+        if row is not None:
+            return row, is_archived
+    return None, False
+
+
+def item_table(kind, archived=False):
+    """Line table holding a document's items"""
+    _, _, _, items, archived_items, _ = DOCUMENTS[kind]
+    return archived_items if archived else items
@@ -0,0 +1,122 @@
+"""In-process product lookup cache.
+
+Scans resolve product codes from an LRU of read-only product snapshots instead
+of querying the products table each time. Coherence across gunicorn workers
+comes from a single catalog_version counter. Every path that changes products
+(add/edit/delete, finalize) bumps it in its own transaction. Each process
+re-reads the counter at most every PRODUCT_CACHE_CHECK_SECONDS and drops its
+entries when it has moved, so a change reaches other workers within that
+interval. Writes in this process invalidate the cache immediately.
+"""
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import select, update
+
+from app import app, db
+from models import CatalogVersion, Product
+
+CachedProduct = namedtuple('CachedProduct', 'id code name unit quantity location min_stock')
+
+
+def _snapshot(product):
+    return CachedProduct(product.id, product.code, product.name, product.unit,
+                         product.quantity, product.location, product.min_stock)
+
+
+def ensure_catalog_version():
+    """Seed the single catalog_version row"""
+    if db.session.get(CatalogVersion, 1) is None:
+        db.session.add(CatalogVersion(id=1, version=0))
+
+
+def bump_catalog_version():
+    """Mark the catalog as changed when the current transaction commits"""
+    db.session.execute(update(CatalogVersion).where(CatalogVersion.id == 1)
+                       .values(version=CatalogVersion.version + 1))
+    product_cache.invalidate()
+
+
+class ProductCache:
+    """Code -> product snapshot LRU, validated against the global catalog version"""
+
+    def __init__(self, max_size, check_interval):
+        self.max_size = max_size
+        self.check_interval = check_interval
+        self._entries = OrderedDict()
+        self._version = None
+        self._checked_at = float('-inf')
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def invalidate(self):
+        """Force a version check on the next lookup"""
+        self._checked_at = float('-inf')
+
+    def _validate(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        version = db.session.execute(select(CatalogVersion.version).where(CatalogVersion.id == 1)).scalar()
+        with self._lock:
+            if version != self._version:
+                if self._version is not None:
+                    self.invalidations += 1
+                self._entries.clear()
+                self._version = version
+            self._checked_at = now
+
+    def _store(self, product):
+        self._entries[product.code] = product
+        self._entries.move_to_end(product.code)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, code):
+        """Snapshot of the product with this code, None if there is none"""
+        return self.get_many([code]).get(code)
+
+    def get_many(self, codes):
+        """{code: snapshot} for the codes that exist; misses are loaded with one IN query"""
+        self._validate()
+        found = {}
+        missing = []
+        with self._lock:
+            for code in set(codes):
+                product = self._entries.get(code)
+                if product is None:
+                    missing.append(code)
+                else:
+                    self._entries.move_to_end(code)
+                    found[code] = product
+            self.hits += len(found)
+            self.misses += len(missing)
+
+        if missing:
+            loaded = [_snapshot(product) for product in Product.query.filter(Product.code.in_(missing))]
+            with self._lock:
+                for product in loaded:
+                    self._store(product)
+                    found[product.code] = product
+        return found
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'version': self._version,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else None,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+product_cache = ProductCache(app.config['PRODUCT_CACHE_SIZE'], app.config['PRODUCT_CACHE_CHECK_SECONDS'])
@@ -0,0 +1,102 @@
+"""Precomputed product-picker payload.
+
+The bill and reception create pages don't render the catalog. They link
+/catalog/products.json?v=<catalog version>, a compact gzip-compressed list of
+[code, name, unit, location, stock] rows for this instance's site, which
+static/js/catalog_typeahead.js downloads once and searches in the browser.
+
+Each worker builds the payload once per catalog version. Finalizes bump that
+version too, so a busy site would rebuild on every page view: the version is
+only re-checked every CATALOG_PAYLOAD_CHECK_SECONDS. Picker stock may lag by
+that much; add_item checks stock itself. A versioned URL always names the same
+bytes, so it is served as immutable and cached by browsers and proxies.
+
+While one thread rebuilds a site's payload, other requests get the previous
+one instead of waiting. A request for a newer version than the worker holds
+(another worker linked it) re-checks the version at once, so workers that
+checked at different times don't redirect a client back and forth.
+"""
+import gzip
+import json
+import threading
+import time
+from collections import namedtuple
+
+from sqlalchemy import func, select
+
+from app import app, db
+from models import CatalogVersion, Product, ProductStock, Location
+from stock import site_filter
+
+FIELDS = ('code', 'name', 'unit', 'location', 'stock')
+
+Payload = namedtuple('Payload', 'version etag body checked_at')
+
+
+def build_payload(site, version):
+    """gzip-compressed JSON of every product with its stock in the site"""
+    stock = (
+        site_filter(
+            db.session.query(ProductStock.product_id, func.sum(ProductStock.quantity).label('quantity'))
+            .join(Location, Location.id == ProductStock.location_id),
+            site)
+        .group_by(ProductStock.product_id)
+        .subquery()
+    )
+    rows = (
+        db.session.query(Product.code, Product.name, Product.unit, Product.location,
+                         func.coalesce(stock.c.quantity, 0.0))
+        .outerjoin(stock, stock.c.product_id == Product.id)
+        .order_by(Product.name)
+    )
+    body = json.dumps({'version': version, 'fields': FIELDS, 'products': [list(row) for row in rows]},
+                      separators=(',', ':'), ensure_ascii=False).encode()
+    return Payload(version, f'{site or "all"}-{version}', gzip.compress(body, 6), time.monotonic())
+
+
+class CatalogPayloads:
+    """Latest payload per site, rebuilt when the catalog version has moved"""
+
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self._payloads = {}
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self.builds = 0
+
+    def _site_lock(self, site):
+        with self._locks_lock:
+            return self._locks.setdefault(site, threading.Lock())
+
+    def _usable(self, payload, seen_version):
+        """Cached payload is at least as new as what the client has seen"""
+        return payload is not None and (seen_version is None or seen_version <= payload.version)
+
+    def current(self, site, seen_version=None):
+        """Latest payload of the site; seen_version is a version the client was already sent to"""
+        payload = self._payloads.get(site)
+        if self._usable(payload, seen_version) and time.monotonic() - payload.checked_at < self.check_interval:
+            return payload
+
+        # One thread per site checks and rebuilds; the others keep serving the previous payload,
+        # unless they have nothing usable and must wait for it
+        lock = self._site_lock(site)
+        if not lock.acquire(blocking=not self._usable(payload, seen_version)):
+            return payload
+        try:
+            payload = self._payloads.get(site)
+            if self._usable(payload, seen_version) and time.monotonic() - payload.checked_at < self.check_interval:
+                return payload
+            version = db.session.execute(select(CatalogVersion.version).where(CatalogVersion.id == 1)).scalar()
+            if payload is not None and payload.version == version:
+                payload = payload._replace(checked_at=time.monotonic())
+            else:
+                payload = build_payload(site, version)
+                self.builds += 1
+            self._payloads[site] = payload
+        finally:
+            lock.release()
+        return payload
+
+
+catalog_payloads = CatalogPayloads(app.config['CATALOG_PAYLOAD_CHECK_SECONDS'])
@@ -0,0 +1,417 @@
+"""Edge node mode: local SQLite store with batched sync to the central instance.
+
+An edge node (EDGE_MODE=1) serves one site's terminals from a local SQLite
+database in WAL mode, so scans and finalizes never wait on the WAN. Finalized
+bills, receptions and manual stock changes are also written to sync_journal in
+the same local transaction.
+
+`flask --app app sync` (once, or with --loop) then:
+
+* pushes pending journal entries to the central instance's /sync/push in
+  gzip-compressed batches. The central instance replays each entry once,
+  remembered in sync_applied by entry id, so a batch re-sent after a timeout is
+  harmless. Stock is always replayed as relative deltas, so concurrent edges and
+  central edits add up instead of overwriting each other. Deltas that drive a
+  location negative are recorded in sync_conflicts. A document naming a product
+  the central database doesn't have is deferred, not acknowledged: it stays in
+  the journal and is sent again on the next sync.
+* pulls products changed since the last pull from /sync/catalog and rebases
+  local quantities: central quantity plus this node's still-unsynced deltas.
+  Products added or edited on an edge are journaled as their own entries, ahead
+  of any document using them; the central catalog wins for product text on pull.
+"""
+import gzip
+import json
+import logging
+import time
+import urllib.parse
+import urllib.request
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import update, or_, and_
+
+from app import app, db
+from models import (Product, Location, ProductStock, ConsumptionBill, BillItem, ReceptionSheet, ReceptionItem,
+                    SyncJournal, SyncState, SyncApplied, SyncConflict)
+from stock import get_or_create_location, apply_stock_delta
+from lines import current_version
+from events import publish, stock_levels, publish_stock_crossings
+from reports import record_document
+from catalog_cache import bump_catalog_version
+
+logger = logging.getLogger(__name__)
+
+CATALOG_PAGE_SIZE = 5000
+# Re-read a little before the watermark so rows committed late are not missed
+CATALOG_OVERLAP = timedelta(seconds=60)
+HTTP_TIMEOUT = 30
+
+
+def edge_mode():
+    return app.config['EDGE_MODE']
+
+
+# --- Edge side: journal ---------------------------------------------------
+
+def _journal(kind, payload):
+    db.session.add(SyncJournal(entry_id=str(uuid.uuid4()), kind=kind, payload=json.dumps(payload, default=str)))
+
+
+def journal_document(kind, document):
+    """Journal a finalized bill or reception for the central database (edge mode only)"""
+    if not edge_mode():
+        return
+    lines = [{
+        'code': db.session.get(Product, item.product_id).code,
+        'location': db.session.get(Location, item.location_id).code,
+        'quantity': item.quantity,
+    } for item in document.items]
+    if kind == 'bill':
+        payload = {'site': document.site, 'date': document.bill_date, 'employee_name': document.employee_name,
+                   'employee_signature': document.employee_signature, 'lines': lines}
+    else:
+        payload = {'site': document.site, 'date': document.reception_date, 'supplier': document.supplier,
+                   'document_number': document.document_number, 'notes': document.notes, 'lines': lines}
+    _journal(kind, payload)
+
+
+def journal_product(product, previous_code=None):
+    """Journal a product added or edited on this node, whatever its stock (edge mode only)"""
+    if not edge_mode():
+        return
+    _journal('product', {'code': product.code, 'previous_code': previous_code, 'name': product.name,
+                         'unit': product.unit, 'product_location': product.location,
+                         'min_stock': product.min_stock})
+
+
+def journal_stock_delta(product, location, delta):
+    """Journal a manual stock change from the product form (edge mode only)"""
+    if not edge_mode() or not delta:
+        return
+    # Product text rides along so products added on the edge can be created centrally
+    _journal('stock_delta', {'site': location.site, 'code': product.code, 'location': location.code,
+                             'delta': delta, 'name': product.name, 'unit': product.unit,
+                             'product_location': product.location, 'min_stock': product.min_stock})
+
+
+def _line_deltas(kind, payload):
+    """(code, location) -> signed stock delta carried by one journal entry"""
+    if kind == 'product':
+        return []
+    if kind == 'stock_delta':
+        return [((payload['code'], payload['location']), payload['delta'])]
+    sign = -1 if kind == 'bill' else 1
+    return [((line['code'], line['location']), sign * line['quantity']) for line in payload['lines']]
+
+
+# --- Edge side: sync client -----------------------------------------------
+
+def _request(path, body=None):
+    url = app.config['CENTRAL_URL'].rstrip('/') + path
+    headers = {'Authorization': f"Bearer {app.config['SYNC_TOKEN']}", 'Accept-Encoding': 'gzip'}
+    data = None
+    if body is not None:
+        data = gzip.compress(json.dumps(body, default=str).encode())
+        headers.update({'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+    with urllib.request.urlopen(urllib.request.Request(url, data=data, headers=headers), timeout=HTTP_TIMEOUT) as response:
+        raw = response.read()
+        if response.headers.get('Content-Encoding') == 'gzip':
+            raw = gzip.decompress(raw)
+    return json.loads(raw)
+
+
+def push_pending(batch_size=None):
+    """Send unsynced journal entries to the central instance; returns how many were acknowledged"""
+    batch_size = batch_size or app.config['EDGE_SYNC_BATCH_SIZE']
+    pushed = 0
+    while True:
+        entries = (
+            SyncJournal.query
+            .filter(SyncJournal.synced_at.is_(None))
+            .order_by(SyncJournal.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not entries:
+            return pushed
+
+        result = _request('/sync/push', {
+            'node_id': app.config['EDGE_NODE_ID'],
+            'batch_id': str(uuid.uuid4()),
+            'entries': [{'entry_id': entry.entry_id, 'kind': entry.kind, 'payload': json.loads(entry.payload)}
+                        for entry in entries],
+        })
+        acknowledged = set(result['applied']) | set(result['duplicates'])
+        now = datetime.utcnow()
+        for entry in entries:
+            if entry.entry_id in acknowledged:
+                entry.synced_at = now
+        db.session.commit()
+        pushed += len(acknowledged)
+        logger.info('Pushed %d journal entries (%d already applied, %d deferred, %d conflicts)',
+                    len(result['applied']), len(result['duplicates']), len(result.get('deferred', [])),
+                    result['conflicts'])
+        if not acknowledged:
+            # Only deferred entries left; they are sent again on the next sync
+            return pushed
+
+
+def _pending_deltas():
+    pending = defaultdict(float)
+    for entry in SyncJournal.query.filter(SyncJournal.synced_at.is_(None)):
+        for key, delta in _line_deltas(entry.kind, json.loads(entry.payload)):
+            pending[key] += delta
+    return pending
+
+
+def _set_location_stock(product_id, location_id, quantity):
+    updated = db.session.execute(
+        update(ProductStock)
+        .where(ProductStock.product_id == product_id, ProductStock.location_id == location_id)
+        .values(quantity=quantity)
+    ).rowcount
+    if not updated:
+        db.session.add(ProductStock(product_id=product_id, location_id=location_id, quantity=quantity))
+
+
+def apply_catalog(rows, site):
+    """Rebase local products on central rows: central quantity plus unsynced local deltas"""
+    pending = _pending_deltas()
+    for row in rows:
+        product = Product.query.filter_by(code=row['code']).first()
+        if product is None:
+            product = Product(code=row['code'], quantity=0.0)
+            db.session.add(product)
+        product.name = row['name']
+        product.unit = row['unit']
+        product.location = row['location']
+        product.min_stock = row['min_stock']
+        db.session.flush()
+
+        local = {stock.location.code: stock.location for stock in product.stock if stock.location.site == site}
+        central = dict(row['stock'])
+        mine = {location: delta for (code, location), delta in pending.items() if code == product.code}
+        total = 0.0
+        for location_code in set(local) | set(central) | set(mine):
+            location = local.get(location_code) or get_or_create_location(location_code, site)
+            quantity = central.get(location_code, 0.0) + mine.get(location_code, 0.0)
+            _set_location_stock(product.id, location.id, quantity)
+            total += quantity
+        # The edge database only holds this site's locations, so its total is the site total
+        product.quantity = total
+        current_version(product)
+
+
+def pull_catalog():
+    """Fetch products changed on the central instance and rebase local stock; returns rows applied"""
+    site = app.config['INVENTORY_SITE']
+    state = db.session.get(SyncState, 'catalog_since')
+    if state is None:
+        state = SyncState(key='catalog_since', value='')
+        db.session.add(state)
+    since, after_id = state.value, 0
+    if since:
+        since = (datetime.fromisoformat(since) - CATALOG_OVERLAP).isoformat()
+    applied = 0
+    while True:
+        query = urllib.parse.urlencode({'site': site or '', 'since': since, 'after_id': after_id,
+                                        'limit': CATALOG_PAGE_SIZE})
+        rows = _request(f'/sync/catalog?{query}')['products']
+        apply_catalog(rows, site)
+        if rows:
+            since, after_id = rows[-1]['updated_at'], rows[-1]['id']
+            state.value = max(state.value, since)
+        bump_catalog_version()
+        db.session.commit()
+        applied += len(rows)
+        if len(rows) < CATALOG_PAGE_SIZE:
+            return applied
+
+
+def sync_once():
+    pushed = push_pending()
+    pulled = pull_catalog()
+    return pushed, pulled
+
+
+def sync_loop(interval):
+    while True:
+        try:
+            sync_once()
+        except Exception:
+            db.session.rollback()
+            logger.exception('Sync with the central instance failed, retrying in %ss', interval)
+        time.sleep(interval)
+
+
+# --- Central side -----------------------------------------------------------
+
+def _conflict(entry_id, node_id, reason, code=None, detail=None):
+    db.session.add(SyncConflict(entry_id=entry_id, node_id=node_id, product_code=code, reason=reason,
+                                detail=detail))
+    return 1
+
+
+def _conflict_once(entry_id, node_id, reason, code=None, detail=None):
+    """Record a conflict for an entry that will be pushed again, without repeating it on every retry"""
+    if SyncConflict.query.filter_by(entry_id=entry_id, reason=reason, product_code=code).first() is not None:
+        return 0
+    return _conflict(entry_id, node_id, reason, code, detail)
+
+
+def _check_negative(entry_id, node_id, product, location):
+    quantity = db.session.query(ProductStock.quantity).filter_by(
+        product_id=product.id, location_id=location.id).scalar()
+    if quantity is not None and quantity < 0:
+        return _conflict(entry_id, node_id, 'negative_stock', product.code,
+                         f'{location.code}: {quantity}')
+    return 0
+
+
+def _document_products(payload):
+    """{code: Product} of a document entry's lines that exist centrally"""
+    return {product.code: product for product in
+            Product.query.filter(Product.code.in_({line['code'] for line in payload['lines']}))}
+
+
+def _apply_document(entry_id, node_id, kind, payload, products):
+    site = payload.get('site')
+    levels = stock_levels([product.id for product in products.values()], site)
+    conflicts = 0
+
+    lines = [(products[line['code']], get_or_create_location(line['location'], site), line['quantity'])
+             for line in payload['lines']]
+    if not lines:
+        return conflicts
+
+    date = datetime.fromisoformat(payload['date'])
+    if kind == 'bill':
+        document = ConsumptionBill(site=site, bill_date=date, employee_name=payload['employee_name'],
+                                   employee_signature=payload['employee_signature'], is_finished=True)
+        item_model, sign = BillItem, -1
+    else:
+        document = ReceptionSheet(site=site, reception_date=date, supplier=payload['supplier'],
+                                  document_number=payload['document_number'], notes=payload['notes'],
+                                  is_finished=True)
+        item_model, sign = ReceptionItem, 1
+    db.session.add(document)
+
+    for number, (product, location, quantity) in enumerate(lines, 1):
+        document.items.append(item_model(item_number=number, product_id=product.id,
+                                         product_version_id=current_version(product).id,
+                                         quantity=quantity, location_id=location.id, entry_date=date))
+        apply_stock_delta(product.id, location.id, sign * quantity)
+        conflicts += _check_negative(entry_id, node_id, product, location)
+
+    db.session.flush()
+    record_document(kind, document)
+    publish(f'{"bill" if kind == "bill" else "reception"}_finalized', site, id=document.id, node_id=node_id,
+            items=len(lines))
+    publish_stock_crossings(levels, site)
+    return conflicts
+
+
+def _apply_product(payload):
+    """Create or update a product added or edited on an edge node"""
+    product = Product.query.filter_by(code=payload['code']).first()
+    if product is None and payload.get('previous_code'):
+        product = Product.query.filter_by(code=payload['previous_code']).first()
+    if product is None:
+        product = Product(quantity=0.0)
+        db.session.add(product)
+    product.code = payload['code']
+    product.name = payload['name']
+    product.unit = payload['unit']
+    product.location = payload['product_location']
+    product.min_stock = payload['min_stock']
+    db.session.flush()
+    current_version(product)
+    return 0
+
+
+def _apply_stock_delta(entry_id, node_id, payload):
+    product = Product.query.filter_by(code=payload['code']).first()
+    if product is None:
+        product = Product(code=payload['code'], name=payload['name'], unit=payload['unit'], quantity=0.0,
+                          location=payload['product_location'], min_stock=payload['min_stock'])
+        db.session.add(product)
+        db.session.flush()
+        current_version(product)
+    location = get_or_create_location(payload['location'], payload.get('site'))
+    levels = stock_levels([product.id], payload.get('site'))
+    apply_stock_delta(product.id, location.id, payload['delta'])
+    conflicts = _check_negative(entry_id, node_id, product, location)
+    publish_stock_crossings(levels, payload.get('site'))
+    return conflicts
+
+
+def apply_batch(batch):
+    """Replay a pushed batch in one transaction, skipping entries already applied.
+
+    Documents with lines for products the central database doesn't have are
+    left unapplied and reported as deferred, so the edge keeps them.
+    """
+    node_id, batch_id = batch['node_id'], batch['batch_id']
+    applied, duplicates, deferred, conflicts = [], [], [], 0
+    for entry in batch['entries']:
+        entry_id, kind, payload = entry['entry_id'], entry['kind'], entry['payload']
+        if db.session.get(SyncApplied, entry_id) is not None:
+            duplicates.append(entry_id)
+            continue
+        if kind in ('bill', 'reception'):
+            products = _document_products(payload)
+            missing = sorted({line['code'] for line in payload['lines']} - set(products))
+            if missing:
+                for code in missing:
+                    conflicts += _conflict_once(entry_id, node_id, 'unknown_product', code)
+                deferred.append(entry_id)
+                continue
+
+        db.session.add(SyncApplied(entry_id=entry_id, node_id=node_id, batch_id=batch_id))
+        if kind == 'product':
+            conflicts += _apply_product(payload)
+        elif kind == 'stock_delta':
+            conflicts += _apply_stock_delta(entry_id, node_id, payload)
+        else:
+            conflicts += _apply_document(entry_id, node_id, kind, payload, products)
+        applied.append(entry_id)
+
+    if applied:
+        bump_catalog_version()
+    db.session.commit()
+    return {'applied': applied, 'duplicates': duplicates, 'deferred': deferred, 'conflicts': conflicts}
+
+
+def catalog_rows(site, since, after_id, limit):
+    """Products after the (updated_at, id) cursor, oldest first, with their stock in the site"""
+    query = Product.query
+    if since:
+        since = datetime.fromisoformat(since)
+        query = query.filter(or_(Product.updated_at > since,
+                                 and_(Product.updated_at == since, Product.id > after_id)))
+    products = query.order_by(Product.updated_at, Product.id).limit(limit).all()
+
+    stock = defaultdict(list)
+    if products:
+        rows = (
+            db.session.query(ProductStock.product_id, Location.code, ProductStock.quantity)
+            .join(Location, Location.id == ProductStock.location_id)
+            .filter(ProductStock.product_id.in_([product.id for product in products]))
+        )
+        if site:
+            rows = rows.filter(Location.site == site)
+        for product_id, location_code, quantity in rows:
+            stock[product_id].append((location_code, quantity))
+
+    return [{
+        'id': product.id,
+        'code': product.code,
+        'name': product.name,
+        'unit': product.unit,
+        'location': product.location,
+        'min_stock': product.min_stock,
+        'updated_at': product.updated_at.isoformat(),
+        'stock': stock[product.id],
+    } for product in products]
@@ -0,0 +1,194 @@
+"""Live activity feed for dashboards.
+
+publish() is called inside the write transaction of the finalize and product
+paths, so an event only goes out if its change is committed: on PostgreSQL it
+is a pg_notify(), elsewhere a row in activity_events. Each worker process runs
+one background listener (LISTEN, or polling the table) that fans events out to
+its local subscribers. An idle SSE client therefore costs one waiting thread
+and a queue, not a database connection or a worker. A worker serves at most
+SSE_MAX_CLIENTS streams so dashboards can't take every request thread; clients
+over the limit are told to reconnect later.
+"""
+import json
+import logging
+import queue
+import select
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, text
+
+from app import app, db
+from models import ActivityEvent, Location, Product, ProductStock
+from stock import site_filter
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'inventory_events'
+POLL_INTERVAL = 1.0
+KEEPALIVE_INTERVAL = 15.0
+EVENT_RETENTION = timedelta(hours=1)
+# activity_events is pruned this often; deletes take SQLite's single write lock
+PRUNE_INTERVAL = 300.0
+# Reconnect delay sent to clients turned away while the worker is full
+BUSY_RETRY_MS = 30000
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+class EventBroker:
+    """Fans events from one background listener out to this process's subscribers"""
+
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def subscribe(self, engine, limit=None):
+        """Queue receiving every event from now on, None when limit subscribers are already open"""
+        subscriber = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            if limit is not None and len(self._subscribers) >= limit:
+                return None
+            self._subscribers.add(subscriber)
+            if self._listener is None or not self._listener.is_alive():
+                target = _listen_postgres if engine.dialect.name == 'postgresql' else _poll_table
+                self._listener = threading.Thread(target=target, args=(self, engine), daemon=True,
+                                                  name='event-listener')
+                self._listener.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def dispatch(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                # A stalled client loses events rather than holding up everyone else
+                pass
+
+
+broker = EventBroker()
+
+
+def publish(kind, site=None, **data):
+    """Queue an event for delivery when the current transaction commits"""
+    payload = json.dumps({'kind': kind, 'site': site, 'data': data}, default=str)
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text('SELECT pg_notify(:channel, :payload)'), {'channel': CHANNEL, 'payload': payload})
+    else:
+        db.session.add(ActivityEvent(kind=kind, site=site, payload=payload))
+
+
+def stock_levels(product_ids, site=None):
+    """Product quantities inside the site (catalog totals when unscoped), to detect min_stock crossings"""
+    if not product_ids:
+        return {}
+    if site is None:
+        return dict(db.session.query(Product.id, Product.quantity).filter(Product.id.in_(product_ids)).all())
+
+    # Same per-site totals as the dashboard's low stock list; no stock row here means none left
+    levels = dict.fromkeys(product_ids, 0.0)
+    query = site_filter(
+        db.session.query(ProductStock.product_id, func.sum(ProductStock.quantity))
+        .join(Location, Location.id == ProductStock.location_id)
+        .filter(ProductStock.product_id.in_(product_ids)),
+        site
+    ).group_by(ProductStock.product_id)
+    levels.update(query.all())
+    return levels
+
+
+def publish_stock_crossings(levels_before, site=None):
+    """Publish a low_stock event for every product whose quantity in the site crossed its min_stock.
+
+    levels_before must come from stock_levels() with the same site.
+    """
+    db.session.flush()
+    levels_after = stock_levels(list(levels_before), site)
+    products = Product.query.filter(Product.id.in_(levels_before)).populate_existing().all()
+    for product in products:
+        before, after = levels_before[product.id], levels_after.get(product.id)
+        if product.min_stock is None or before is None or after is None:
+            continue
+        was_low = before <= product.min_stock
+        is_low = after <= product.min_stock
+        if was_low != is_low:
+            publish('low_stock', site, code=product.code, name=product.name, unit=product.unit,
+                    quantity=after, min_stock=product.min_stock, below=is_low)
+
+
+def _listen_postgres(broker, engine):
+    while True:
+        connection = None
+        try:
+            connection = engine.raw_connection()
+            raw = connection.driver_connection
+            raw.autocommit = True
+            raw.cursor().execute(f'LISTEN {CHANNEL}')
+            while True:
+                if select.select([raw], [], [], KEEPALIVE_INTERVAL) == ([], [], []):
+                    continue
+                raw.poll()
+                while raw.notifies:
+                    broker.dispatch(json.loads(raw.notifies.pop(0).payload))
+        except Exception:
+            logger.exception('Event listener lost its connection, reconnecting')
+            time.sleep(POLL_INTERVAL)
+        finally:
+            if connection is not None:
+                connection.close()
+
+
+def _poll_table(broker, engine):
+    last_id = None
+    pruned_at = time.monotonic()
+    while True:
+        try:
+            with engine.begin() as connection:
+                if last_id is None:
+                    last_id = connection.execute(text('SELECT COALESCE(MAX(id), 0) FROM activity_events')).scalar()
+                rows = connection.execute(text(
+                    'SELECT id, payload FROM activity_events WHERE id > :last_id ORDER BY id'
+                ), {'last_id': last_id}).all()
+                for event_id, payload in rows:
+                    broker.dispatch(json.loads(payload))
+                    last_id = event_id
+            if time.monotonic() - pruned_at >= PRUNE_INTERVAL:
+                with engine.begin() as connection:
+                    connection.execute(text('DELETE FROM activity_events WHERE created_at < :cutoff'),
+                                       {'cutoff': datetime.utcnow() - EVENT_RETENTION})
+                pruned_at = time.monotonic()
+        except Exception:
+            logger.exception('Event poller failed, retrying')
+        time.sleep(POLL_INTERVAL)
+
+
+def sse_stream(site=None):
+    """Server-sent event stream of the events visible to a site"""
+    subscriber = broker.subscribe(db.engine, app.config['SSE_MAX_CLIENTS'])
+    if subscriber is None:
+        # EventSource reconnects once the stream ends, after the retry delay
+        return iter([f'retry: {BUSY_RETRY_MS}\n\n'])
+
+    def stream():
+        try:
+            yield f'retry: {int(KEEPALIVE_INTERVAL * 1000)}\n\n'
+            while True:
+                try:
+                    event = subscriber.get(timeout=KEEPALIVE_INTERVAL)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if site is not None and event['site'] not in (site, None):
+                    continue
+                yield f"event: {event['kind']}\ndata: {json.dumps(event['data'])}\n\n"
+        finally:
+            broker.unsubscribe(subscriber)
+
+    return stream()
@@ -0,0 +1,117 @@
+"""Idempotency keys for finalize and batch submissions.
+
+Clients send an Idempotency-Key header (or an idempotency_key form field)
+that stays the same across retries of one submission. The first request claims
+the key before doing any work and stores the created document and its response
+with it, in the same transaction. A retry with the same key gets the stored
+response back without touching items, stock or products again.
+
+Keys are scoped to the browser session that sent them, so a key reused by
+another terminal is a new submission there, never a replay of this one.
+
+Two copies of a request racing each other collide on the unique
+(endpoint, key) index. The loser rolls back before moving stock and replays the
+winner's response. Keys older than IDEMPOTENCY_KEY_TTL_HOURS are deleted in
+batches by `flask --app app expire-idempotency-keys`.
+"""
+import json
+import secrets
+from datetime import datetime, timedelta
+
+from flask import abort, jsonify, redirect, request, session
+from sqlalchemy import delete, select
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from models import IdempotencyKey
+
+KEY_HEADER = 'Idempotency-Key'
+# Leaves room in idempotency_keys.key for the session scope prefix
+MAX_KEY_LENGTH = 64
+SCOPE_SESSION_KEY = 'idempotency_scope'
+EXPIRE_BATCH_SIZE = 1000
+
+
+class DuplicateRequest(Exception):
+    """Another request with the same key got there first; record is its stored result, if committed"""
+
+    def __init__(self, record):
+        super().__init__('Cererea a fost deja procesată')
+        self.record = record
+
+
+def session_scope():
+    """Random prefix for the keys of this session, created on first use.
+
+    Pages that submit keyed requests create it when they render, so a keyed
+    request and its retry (which may carry the session from before a lost
+    response) always share it.
+    """
+    if SCOPE_SESSION_KEY not in session:
+        session[SCOPE_SESSION_KEY] = secrets.token_hex(8)
+    return session[SCOPE_SESSION_KEY]
+
+
+def request_key():
+    """Idempotency key sent with the current request, scoped to its session; None when there is none"""
+    key = (request.headers.get(KEY_HEADER) or request.form.get('idempotency_key') or '').strip()
+    if len(key) > MAX_KEY_LENGTH:
+        abort(400)
+    return f'{session_scope()}:{key}' if key else None
+
+
+def find_key(endpoint, key):
+    """Stored result for a key, None for new (or missing) keys"""
+    if key is None:
+        return None
+    return IdempotencyKey.query.filter_by(endpoint=endpoint, key=key).first()
+
+
+def claim_key(endpoint, key):
+    """Insert the key at the start of the transaction; raises DuplicateRequest if it is taken"""
+    if key is None:
+        return None
+    record = IdempotencyKey(endpoint=endpoint, key=key)
+    db.session.add(record)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        raise DuplicateRequest(find_key(endpoint, key))
+    return record
+
+
+def remember(record, document_id=None, body=None, location=None, status=200):
+    """Store the response for replays; location marks a redirect"""
+    if record is None:
+        return
+    record.document_id = document_id
+    record.response = json.dumps({'status': 302 if location else status, 'body': body, 'location': location},
+                                 default=str)
+
+
+def stored_body(record):
+    return json.loads(record.response)['body']
+
+
+def replay(record):
+    """The stored response of an already processed request"""
+    stored = json.loads(record.response)
+    if stored['location']:
+        return redirect(stored['location'])
+    return jsonify(stored['body']), stored['status']
+
+
+def expire_keys(cutoff=None, batch_size=EXPIRE_BATCH_SIZE):
+    """Delete keys created before cutoff, one short transaction per batch; returns how many"""
+    if cutoff is None:
+        cutoff = datetime.utcnow() - timedelta(hours=app.config['IDEMPOTENCY_KEY_TTL_HOURS'])
+    expired = 0
+    while True:
+        batch = select(IdempotencyKey.id).where(IdempotencyKey.created_at < cutoff).limit(batch_size)
+        ids = db.session.execute(batch).scalars().all()
+        if not ids:
+            return expired
+        db.session.execute(delete(IdempotencyKey).where(IdempotencyKey.id.in_(ids)))
+        db.session.commit()
+        expired += len(ids)
@@ -0,0 +1,182 @@
+"""Document line helpers.
+
+Line tables only store ids: product_id for the live product, product_version_id
+for the code/name/unit the line was written with, and location_id. The text
+shown on views and exports is joined in by the queries below, from the live
+or archive line tables.
+
+Lines also carry their document's date (entry_date), so a product's movement
+history is a range scan of the (product_id, entry_date, id) index of each line
+table, merged newest first.
+"""
+from sqlalchemy import and_, literal, or_, select
+
+from app import db
+from models import Product, ProductVersion, Location
+from archive import DOCUMENTS, is_postgres, item_table
+
+HISTORY_PAGE_SIZE = 100
+
+# kind -> (rank breaking ties on equal timestamps, stock sign, party column of the document)
+MOVEMENT_KINDS = {
+    'bill': (1, -1, 'employee_name'),
+    'reception': (0, 1, 'supplier'),
+}
+
+
+def current_version(product):
+    """Latest version record of a product, recording a new one if its text changed"""
+    version = (
+        ProductVersion.query
+        .filter_by(product_id=product.id)
+        .order_by(ProductVersion.version.desc())
+        .first()
+    )
+    if version is None or (version.code, version.name, version.unit) != (product.code, product.name, product.unit):
+        version = ProductVersion(product_id=product.id,
+                                 version=version.version + 1 if version else 1,
+                                 code=product.code, name=product.name, unit=product.unit)
+        db.session.add(version)
+        db.session.flush()
+    return version
+
+
+def _finished_lines(items, *extra_columns):
+    return (
+        db.session.query(
+            items.c.id,
+            items.c.item_number,
+            items.c.product_id,
+            ProductVersion.code.label('product_code'),
+            ProductVersion.name.label('product_name'),
+            ProductVersion.unit.label('unit'),
+            items.c.quantity,
+            Location.code.label('location'),
+            *extra_columns)
+        .join(ProductVersion, ProductVersion.id == items.c.product_version_id)
+        .outerjoin(Location, Location.id == items.c.location_id)
+    )
+
+
+def bill_lines(bill_id, archived=False):
+    """Lines of a consumption bill with product text as it was when written"""
+    items = item_table('bill', archived)
+    return (
+        _finished_lines(items, items.c.bill_id)
+        .filter(items.c.bill_id == bill_id)
+        .order_by(items.c.item_number)
+        .all()
+    )
+
+
+def reception_lines(reception_id, archived=False):
+    """Lines of a reception sheet with product text as it was when written"""
+    items = item_table('reception', archived)
+    return (
+        _finished_lines(items, items.c.reception_id, items.c.entry_date)
+        .filter(items.c.reception_id == reception_id)
+        .order_by(items.c.item_number)
+        .all()
+    )
+
+
+def lines_by_document(kind, document_ids, archived=False):
+    """{document id: lines} for many documents of one kind, in one query"""
+    items = item_table(kind, archived)
+    document_fk = items.c[DOCUMENTS[kind][5]]
+    grouped = {}
+    if not document_ids:
+        return grouped
+    rows = (
+        _finished_lines(items, document_fk.label('document_id'))
+        .filter(document_fk.in_(document_ids))
+        .order_by(document_fk, items.c.item_number)
+    )
+    for row in rows:
+        grouped.setdefault(row.document_id, []).append(row)
+    return grouped
+
+
+def _draft_lines(item_model, draft_id):
+    return (
+        db.session.query(
+            item_model.item_number,
+            item_model.product_id,
+            Product.code,
+            Product.name,
+            Product.unit,
+            item_model.quantity,
+            item_model.location_id,
+            Location.code.label('location'))
+        .join(Product, Product.id == item_model.product_id)
+        .outerjoin(Location, Location.id == item_model.location_id)
+        .filter(item_model.draft_id == draft_id)
+        .order_by(item_model.item_number)
+        .all()
+    )
+
+
+def draft_session_items(item_model, draft_id):
+    """Draft lines in the session item format used by the create pages"""
+    return [{
+        'item_number': line.item_number,
+        'product_id': line.product_id,
+        'code': line.code,
+        'name': line.name,
+        'unit': line.unit,
+        'quantity': line.quantity,
+        'location': line.location,
+        'location_id': line.location_id
+    } for line in _draft_lines(item_model, draft_id)]
+
+
+def _after_cursor(items, rank, before, before_rank, before_id):
+    """Lines of one kind that sort after the (date, rank, id) cursor, newest first"""
+    if rank < before_rank:
+        return items.c.entry_date <= before
+    if rank > before_rank:
+        return items.c.entry_date < before
+    return or_(items.c.entry_date < before, and_(items.c.entry_date == before, items.c.id < before_id))
+
+
+def product_movements(product_id, site=None, start=None, end=None, cursor=None, limit=HISTORY_PAGE_SIZE):
+    """Consumption and reception lines of a product in [start, end), newest first.
+
+    cursor is the (date, kind, id) of the last line of the previous page. Each
+    line table (live and, off PostgreSQL, archived) is read with one index range
+    scan of at most limit rows; the results are merged here.
+    """
+    rows = []
+    for kind, (rank, sign, party) in MOVEMENT_KINDS.items():
+        documents, archived, date_column, items, archived_items, item_fk = DOCUMENTS[kind]
+        sources = [(documents, items)] if is_postgres() else [(documents, items), (archived, archived_items)]
+        for document_table, line_table in sources:
+            query = (
+                select(
+                    line_table.c.entry_date.label('date'),
+                    literal(kind).label('kind'),
+                    literal(rank).label('rank'),
+                    line_table.c.id,
+                    line_table.c[item_fk].label('document_id'),
+                    (line_table.c.quantity * sign).label('quantity'),
+                    document_table.c[party].label('party'),
+                    Location.code.label('location'))
+                .join(document_table, document_table.c.id == line_table.c[item_fk])
+                .outerjoin(Location, Location.id == line_table.c.location_id)
+                .where(line_table.c.product_id == product_id)
+                .order_by(line_table.c.entry_date.desc(), line_table.c.id.desc())
+                .limit(limit)
+            )
+            if site is not None:
+                query = query.where(document_table.c.site == site)
+            if start is not None:
+                query = query.where(line_table.c.entry_date >= start)
+            if end is not None:
+                query = query.where(line_table.c.entry_date < end)
+            if cursor is not None:
+                before, before_kind, before_id = cursor
+                query = query.where(_after_cursor(line_table, rank, before, MOVEMENT_KINDS[before_kind][0], before_id))
+            rows.extend(db.session.execute(query).all())
+
+    rows.sort(key=lambda row: (row.date, row.rank, row.id), reverse=True)
+    return rows[:limit]
@@ -0,0 +1,172 @@
+"""Structured, non-blocking logging.
+
+Request threads only build the record and drop it on an in-memory queue; a
+single background listener formats it as JSON and writes it out. When the
+queue is full, records are dropped and counted instead of blocking the request.
+Levels are set per logger from the environment, and DEBUG records can be
+sampled so verbose loggers stay usable in production.
+
+    LOG_LEVEL=INFO                                   root level
+    LOG_LEVELS=sqlalchemy.engine=WARNING,werkzeug=INFO  per-logger overrides
+    LOG_DEBUG_SAMPLE_RATE=0.01                       fraction of DEBUG records kept
+    LOG_FORMAT=json|text
+    LOG_QUEUE_SIZE=10000
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import uuid
+from datetime import datetime, timezone
+
+from flask import g, has_request_context, request
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+
+# Chatty third-party loggers, quiet unless LOG_LEVELS says otherwise
+DEFAULT_LEVELS = {
+    'sqlalchemy.engine': 'WARNING',
+    'sqlalchemy.pool': 'WARNING',
+    'werkzeug': 'INFO',
+}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+            'process': record.process,
+            'thread': record.threadName,
+        }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc_info'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class RequestContextFilter(logging.Filter):
+    """Stamp records with the current request id; runs on the request thread, before queueing"""
+
+    def filter(self, record):
+        record.request_id = g.get('request_id') if has_request_context() else None
+        return True
+
+
+class DebugSampler(logging.Filter):
+    """Keep only a fraction of DEBUG records; other levels always pass"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking when the writer falls behind"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Only merge args into the message here; JSON formatting happens on the writer thread
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _parse_levels(spec):
+    levels = {}
+    for part in (spec or '').split(','):
+        name, _, level = part.partition('=')
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+# Writer thread of this process; replaced in forked children
+_listener = None
+
+
+def _start_listener(log_queue, output):
+    global _listener
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=False)
+    _listener.start()
+
+
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+
+def flush_logging():
+    """Write out every queued record; for processes that leave through os._exit() and skip atexit"""
+    _stop_listener()
+    if _listener is not None:
+        _listener.start()
+
+
+def configure_logging(app):
+    """Route all logging through the background writer and add request ids to app requests"""
+    output = logging.StreamHandler()
+    if os.environ.get('LOG_FORMAT', 'json') == 'text':
+        output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s'))
+    else:
+        output.setFormatter(JsonFormatter())
+
+    queue_size = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+    handler = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+    handler.addFilter(DebugSampler(float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', '0.01'))))
+    handler.addFilter(RequestContextFilter())
+    _start_listener(handler.queue, output)
+    atexit.register(_stop_listener)
+
+    def restart_in_child():
+        # A forked child (gunicorn --preload, stress workers) inherits the queue but not
+        # the writer thread; give it a fresh queue, whose lock may have been held at fork
+        handler.queue = queue.Queue(maxsize=queue_size)
+        _start_listener(handler.queue, output)
+
+    os.register_at_fork(after_in_child=restart_in_child)
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+    for name, level in {**DEFAULT_LEVELS, **_parse_levels(os.environ.get('LOG_LEVELS'))}.items():
+        logging.getLogger(name).setLevel(level)
+
+    @app.before_request
+    def assign_request_id():
+        g.request_id = request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+
+    @app.after_request
+    def echo_request_id(response):
+        response.headers[REQUEST_ID_HEADER] = g.get('request_id', '')
+        return response
+
+    return handler
@@ -0,0 +1,304 @@
+"""In-place schema upgrades run by init_db().
+
+db.create_all() only creates missing tables, so columns and indexes added to
+existing tables are applied here. Every step checks the live schema first and
+is safe to run on each start.
+"""
+import logging
+
+from sqlalchemy import Float, inspect, text
+
+from app import db
+from quantities import Quantity, QUANTITY_SCALE
+
+logger = logging.getLogger(__name__)
+
+# table -> [(column, DDL type)]; new columns on existing tables must be nullable
+ADDED_COLUMNS = {
+    'consumption_bills': [('site', 'VARCHAR(50)')],
+    'reception_sheets': [('site', 'VARCHAR(50)')],
+    'draft_bills': [('site', 'VARCHAR(50)')],
+    'draft_receptions': [('site', 'VARCHAR(50)')],
+    'bill_items': [('location_id', 'INTEGER REFERENCES locations(id)'),
+                   ('product_id', 'INTEGER REFERENCES products(id) ON DELETE SET NULL'),
+                   ('product_version_id', 'INTEGER REFERENCES product_versions(id)'),
+                   ('entry_date', 'TIMESTAMP')],
+    'bill_items_archive': [('entry_date', 'TIMESTAMP')],
+    'reception_items': [('location_id', 'INTEGER REFERENCES locations(id)'),
+                        ('product_id', 'INTEGER REFERENCES products(id) ON DELETE SET NULL'),
+                        ('product_version_id', 'INTEGER REFERENCES product_versions(id)')],
+    'draft_bill_items': [('location_id', 'INTEGER REFERENCES locations(id)'),
+                         ('product_id', 'INTEGER REFERENCES products(id) ON DELETE CASCADE')],
+    'draft_reception_items': [('location_id', 'INTEGER REFERENCES locations(id)'),
+                              ('product_id', 'INTEGER REFERENCES products(id) ON DELETE CASCADE')],
+}
+
+# line table -> (document table, document FK column, keeps product versions)
+LINE_TABLES = {
+    'bill_items': ('consumption_bills', 'bill_id', True),
+    'reception_items': ('reception_sheets', 'reception_id', True),
+    'draft_bill_items': ('draft_bills', 'draft_id', False),
+    'draft_reception_items': ('draft_receptions', 'draft_id', False),
+}
+
+# Text copied into every line before lines referenced products by id
+LEGACY_LINE_COLUMNS = ('product_code', 'product_name', 'unit', 'location')
+
+# line table -> (document table, document FK column, document date column); lines carry the date for history
+DATED_LINE_TABLES = {
+    'bill_items': ('consumption_bills', 'bill_id', 'bill_date'),
+    'bill_items_archive': ('consumption_bills_archive', 'bill_id', 'bill_date'),
+    'reception_items': ('reception_sheets', 'reception_id', 'reception_date'),
+    'reception_items_archive': ('reception_sheets_archive', 'reception_id', 'reception_date'),
+}
+
+# PRAGMA user_version of SQLite databases whose product references match the products table
+FOREIGN_KEYS_VERSION = 1
+
+# Single-column product indexes covered by the (product_id, entry_date, id) indexes
+OBSOLETE_INDEXES = ('ix_bill_items_product_id', 'ix_reception_items_product_id',
+                    'ix_bill_items_archive_product', 'ix_reception_items_archive_product')
+
+
+def add_missing_columns():
+    """ALTER existing tables to add columns declared after they were created"""
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    for table, columns in ADDED_COLUMNS.items():
+        if table not in tables:
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table)}
+        for name, ddl in columns:
+            if name not in existing:
+                logger.info('Adding column %s.%s', table, name)
+                db.session.execute(text(f'ALTER TABLE {table} ADD COLUMN {name} {ddl}'))
+    db.session.commit()
+
+
+def _backfill_versions(table):
+    """Record one product version per distinct line text and point the lines at it"""
+    texts = db.session.execute(text(
+        f'SELECT DISTINCT product_code, product_name, unit FROM {table} WHERE product_version_id IS NULL'
+    )).all()
+    for code, name, unit in texts:
+        exists = db.session.execute(text(
+            'SELECT 1 FROM product_versions WHERE code = :code AND name = :name AND unit = :unit'
+        ), {'code': code, 'name': name, 'unit': unit}).first()
+        if exists:
+            continue
+        product_id = db.session.execute(text('SELECT id FROM products WHERE code = :code'), {'code': code}).scalar()
+        version = db.session.execute(text(
+            'SELECT COALESCE(MAX(version), 0) + 1 FROM product_versions WHERE product_id = :product_id'
+        ), {'product_id': product_id}).scalar() if product_id is not None else 1
+        db.session.execute(text(
+            'INSERT INTO product_versions (product_id, version, code, name, unit, created_at) '
+            'VALUES (:product_id, :version, :code, :name, :unit, CURRENT_TIMESTAMP)'
+        ), {'product_id': product_id, 'version': version, 'code': code, 'name': name, 'unit': unit})
+
+    # One pass over the line table, resolved through ix_product_versions_text
+    db.session.execute(text(
+        f'UPDATE {table} SET product_version_id = ('
+        f'SELECT MIN(v.id) FROM product_versions v WHERE v.code = {table}.product_code '
+        f'AND v.name = {table}.product_name AND v.unit = {table}.unit) '
+        f'WHERE product_version_id IS NULL'
+    ))
+
+
+def _backfill_locations(table, document_table, document_fk):
+    """Resolve the free-text location of each line to a location of its document's site"""
+    from stock import get_or_create_location
+
+    pairs = db.session.execute(text(
+        f'SELECT DISTINCT d.site, i.location FROM {table} i JOIN {document_table} d ON d.id = i.{document_fk} '
+        f"WHERE i.location_id IS NULL AND i.location IS NOT NULL AND i.location <> ''"
+    )).all()
+    for site, code in pairs:
+        location = get_or_create_location(code, site)
+        site_clause = 'site IS NULL' if site is None else 'site = :site'
+        db.session.execute(text(
+            f'UPDATE {table} SET location_id = :location_id '
+            f'WHERE location_id IS NULL AND location = :code '
+            f'AND {document_fk} IN (SELECT id FROM {document_table} WHERE {site_clause})'
+        ), {'location_id': location.id, 'code': code, 'site': site})
+
+
+def normalize_line_tables():
+    """Replace the text copied into line tables with product, version and location ids"""
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    for table, (document_table, document_fk, versioned) in LINE_TABLES.items():
+        if table not in tables:
+            continue
+        columns = {column['name'] for column in inspector.get_columns(table)}
+        if 'product_code' not in columns:
+            continue
+
+        logger.info('Normalizing %s to product references', table)
+        db.session.execute(text(
+            f'UPDATE {table} SET product_id = (SELECT p.id FROM products p WHERE p.code = {table}.product_code) '
+            f'WHERE product_id IS NULL'
+        ))
+        if versioned:
+            _backfill_versions(table)
+        else:
+            # Drafts only make sense for products that still exist
+            db.session.execute(text(f'DELETE FROM {table} WHERE product_id IS NULL'))
+        _backfill_locations(table, document_table, document_fk)
+
+        for column in LEGACY_LINE_COLUMNS:
+            db.session.execute(text(f'ALTER TABLE {table} DROP COLUMN {column}'))
+        db.session.commit()
+
+
+def backfill_line_dates():
+    """Copy the document date onto lines written before lines carried one"""
+    tables = set(inspect(db.engine).get_table_names())
+    for table, (document_table, document_fk, date_column) in DATED_LINE_TABLES.items():
+        if table not in tables or document_table not in tables:
+            continue
+        db.session.execute(text(
+            f'UPDATE {table} SET entry_date = (SELECT d.{date_column} FROM {document_table} d '
+            f'WHERE d.id = {table}.{document_fk}) WHERE entry_date IS NULL'
+        ))
+    db.session.commit()
+
+
+def drop_obsolete_indexes():
+    for index in OBSOLETE_INDEXES:
+        db.session.execute(text(f'DROP INDEX IF EXISTS {index}'))
+    db.session.commit()
+
+
+def _quantity_columns():
+    """(table, column) of every Quantity column, live and archive tables"""
+    from archive import archive_metadata
+
+    for metadata in (db.metadata, archive_metadata):
+        for table in metadata.sorted_tables:
+            for column in table.columns:
+                if isinstance(column.type, Quantity):
+                    yield table, column
+
+
+def convert_quantity_columns():
+    """Rewrite FLOAT quantity columns as BIGINT counts of 1/QUANTITY_SCALE units"""
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    postgres = db.engine.dialect.name == 'postgresql'
+    for table, column in _quantity_columns():
+        if table.name not in tables:
+            continue
+        existing = {info['name']: info['type'] for info in inspector.get_columns(table.name)}
+        if not isinstance(existing.get(column.name), Float):
+            continue
+
+        logger.info('Converting %s.%s to fixed point', table.name, column.name)
+        name = column.name
+        if postgres:
+            db.session.execute(text(
+                f'ALTER TABLE {table.name} ALTER COLUMN {name} TYPE BIGINT USING round({name} * {QUANTITY_SCALE})'
+            ))
+            continue
+
+        # SQLite can't change a column's type: add the new column, copy, drop the old one.
+        # Indexes on the old column block the drop; create_missing_indexes() puts them back.
+        for index in inspector.get_indexes(table.name):
+            if name in index['column_names']:
+                db.session.execute(text(f'DROP INDEX {index["name"]}'))
+        not_null = '' if column.nullable else ' NOT NULL DEFAULT 0'
+        db.session.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {name}_fixed BIGINT{not_null}'))
+        db.session.execute(text(
+            f'UPDATE {table.name} SET {name}_fixed = CAST(ROUND({name} * {QUANTITY_SCALE}) AS INTEGER)'
+        ))
+        db.session.execute(text(f'ALTER TABLE {table.name} DROP COLUMN {name}'))
+        db.session.execute(text(f'ALTER TABLE {table.name} RENAME COLUMN {name}_fixed TO {name}'))
+    db.session.commit()
+
+
+def clear_orphan_product_refs():
+    """Null or delete references to products deleted while SQLite foreign keys were off.
+
+    Runs once per SQLite database (PRAGMA user_version); PostgreSQL always
+    enforced the ON DELETE rules.
+    """
+    from archive import archive_metadata
+
+    if db.engine.dialect.name != 'sqlite':
+        return
+    if db.session.execute(text('PRAGMA user_version')).scalar() >= FOREIGN_KEYS_VERSION:
+        return
+
+    tables = set(inspect(db.engine).get_table_names())
+    orphan = 'product_id IS NOT NULL AND product_id NOT IN (SELECT id FROM products)'
+    for table in db.metadata.sorted_tables:
+        for foreign_key in table.foreign_keys:
+            if foreign_key.target_fullname != 'products.id' or table.name not in tables:
+                continue
+            if foreign_key.ondelete == 'CASCADE':
+                db.session.execute(text(f'DELETE FROM {table.name} WHERE {orphan}'))
+            else:
+                db.session.execute(text(f'UPDATE {table.name} SET product_id = NULL WHERE {orphan}'))
+    for table in archive_metadata.sorted_tables:
+        if 'product_id' in table.c and table.name in tables:
+            db.session.execute(text(f'UPDATE {table.name} SET product_id = NULL WHERE {orphan}'))
+    db.session.execute(text(f'PRAGMA user_version = {FOREIGN_KEYS_VERSION}'))
+    db.session.commit()
+
+
+def merge_unscoped_locations():
+    """Fold duplicate site-less locations into the oldest one before their unique index is created.
+
+    uq_locations_site_code never compared NULL sites, so concurrent first uses
+    of a code on an unscoped instance could each create a location.
+    """
+    from archive import archive_metadata
+
+    tables = set(inspect(db.engine).get_table_names())
+    if 'locations' not in tables:
+        return
+    duplicates = db.session.execute(text(
+        'SELECT code, MIN(id) FROM locations WHERE site IS NULL GROUP BY code HAVING COUNT(*) > 1'
+    )).all()
+    referencing = [table.name for metadata in (db.metadata, archive_metadata) for table in metadata.sorted_tables
+                   if 'location_id' in table.c and table.name in tables and table.name != 'product_stock']
+    for code, keep in duplicates:
+        logger.info('Merging duplicate location %s', code)
+        params = {'code': code, 'keep': keep}
+        others = 'SELECT id FROM locations WHERE site IS NULL AND code = :code AND id <> :keep'
+        # The kept location gets one stock row per product, holding the sum of all copies
+        db.session.execute(text(
+            f'INSERT INTO product_stock (product_id, location_id, quantity) '
+            f'SELECT DISTINCT product_id, :keep, 0 FROM product_stock WHERE location_id IN ({others}) '
+            f'AND product_id NOT IN (SELECT product_id FROM product_stock WHERE location_id = :keep)'
+        ), params)
+        db.session.execute(text(
+            f'UPDATE product_stock SET quantity = quantity + (SELECT COALESCE(SUM(s.quantity), 0) '
+            f'FROM product_stock s WHERE s.product_id = product_stock.product_id AND s.location_id IN ({others})) '
+            f'WHERE location_id = :keep'
+        ), params)
+        db.session.execute(text(f'DELETE FROM product_stock WHERE location_id IN ({others})'), params)
+        for table in referencing:
+            db.session.execute(text(
+                f'UPDATE {table} SET location_id = :keep WHERE location_id IN ({others})'
+            ), params)
+        db.session.execute(text(f'DELETE FROM locations WHERE id IN ({others})'), params)
+    db.session.commit()
+
+
+def create_missing_indexes():
+    """Create declared indexes that are missing on tables that already existed"""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+def run_migrations():
+    """Bring an existing database up to the current models"""
+    add_missing_columns()
+    normalize_line_tables()
+    clear_orphan_product_refs()
+    backfill_line_dates()
+    drop_obsolete_indexes()
+    convert_quantity_columns()
+    merge_unscoped_locations()
+    create_missing_indexes()
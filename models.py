@@ -1,23 +1,101 @@
 from app import db
 from datetime import datetime
 
+from quantities import Quantity
+
 class Product(db.Model):
     __tablename__ = 'products'
+    __table_args__ = (
+        db.Index('ix_products_updated_at', 'updated_at', 'id'),
+        # Never hand a deleted product's id to a new one: archived lines still carry it
+        {'sqlite_autoincrement': True},
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     code = db.Column(db.String(50), unique=True, nullable=False)
     name = db.Column(db.String(200), nullable=False)
     unit = db.Column(db.String(20), nullable=False)
-    quantity = db.Column(db.Float, nullable=False, default=0.0)
+    quantity = db.Column(Quantity, nullable=False, default=0.0)
     location = db.Column(db.String(100))
-    min_stock = db.Column(db.Float, default=5.0)
+    min_stock = db.Column(Quantity, default=5.0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # Per-location stock rows; quantity above is their running total
+    stock = db.relationship('ProductStock', backref='product', lazy=True, cascade='all, delete-orphan')
+
+class Unit(db.Model):
+    __tablename__ = 'units'
+    
+    # Decimals a quantity in this unit may have; quantities are stored in thousandths, so at most 3
+    code = db.Column(db.String(20), primary_key=True)
+    decimals = db.Column(db.Integer, nullable=False, default=3)
+
+class CatalogVersion(db.Model):
+    __tablename__ = 'catalog_version'
+    
+    # Single row bumped by every product change; workers compare it to drop cached products
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+class ProductVersion(db.Model):
+    __tablename__ = 'product_versions'
+    __table_args__ = (
+        db.UniqueConstraint('product_id', 'version', name='uq_product_versions_product_version'),
+        db.Index('ix_product_versions_text', 'code', 'name', 'unit'),
+    )
+    
+    # Immutable snapshot of a product's text; document lines point here for history
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id', ondelete='SET NULL'))
+    version = db.Column(db.Integer, nullable=False, default=1)
+    code = db.Column(db.String(50), nullable=False)
+    name = db.Column(db.String(200), nullable=False)
+    unit = db.Column(db.String(20), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Location(db.Model):
+    __tablename__ = 'locations'
+    __table_args__ = (
+        db.UniqueConstraint('site', 'code', name='uq_locations_site_code'),
+        # NULLs never collide in the constraint above; unscoped locations need their own
+        db.Index('uq_locations_unscoped_code', 'code', unique=True,
+                 sqlite_where=db.text('site IS NULL'), postgresql_where=db.text('site IS NULL')),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    site = db.Column(db.String(50), index=True)
+    code = db.Column(db.String(100), nullable=False)
+    name = db.Column(db.String(200))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ProductStock(db.Model):
+    __tablename__ = 'product_stock'
+    __table_args__ = (
+        db.UniqueConstraint('product_id', 'location_id', name='uq_product_stock_product_location'),
+        db.Index('ix_product_stock_location_product', 'location_id', 'product_id'),
+        db.Index('ix_product_stock_location_quantity', 'location_id', 'quantity'),
+        db.Index('ix_product_stock_updated_at', 'updated_at', 'id'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id', ondelete='CASCADE'), nullable=False)
+    location_id = db.Column(db.Integer, db.ForeignKey('locations.id'), nullable=False)
+    quantity = db.Column(Quantity, nullable=False, default=0.0)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    location = db.relationship('Location', lazy='joined')
 
 class ConsumptionBill(db.Model):
     __tablename__ = 'consumption_bills'
+    __table_args__ = (
+        db.Index('ix_consumption_bills_site_date', 'site', 'bill_date'),
+        # Unscoped instances page and filter by date alone
+        db.Index('ix_consumption_bills_date', 'bill_date', 'id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
+    site = db.Column(db.String(50))
     bill_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     employee_name = db.Column(db.String(100), nullable=False)
     employee_signature = db.Column(db.String(100))
@@ -29,20 +107,29 @@ class ConsumptionBill(db.Model):
 
 class BillItem(db.Model):
     __tablename__ = 'bill_items'
+    __table_args__ = (
+        db.Index('ix_bill_items_product_date', 'product_id', 'entry_date', 'id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     bill_id = db.Column(db.Integer, db.ForeignKey('consumption_bills.id'), nullable=False)
     item_number = db.Column(db.Integer, nullable=False)
-    product_code = db.Column(db.String(50), nullable=False)
-    product_name = db.Column(db.String(200), nullable=False)
-    unit = db.Column(db.String(20), nullable=False)
-    quantity = db.Column(db.Float, nullable=False)
-    location = db.Column(db.String(100))
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id', ondelete='SET NULL'))
+    product_version_id = db.Column(db.Integer, db.ForeignKey('product_versions.id'), nullable=False)
+    quantity = db.Column(Quantity, nullable=False)
+    location_id = db.Column(db.Integer, db.ForeignKey('locations.id'))
+    # Bill date copied onto the line so a product's history is one index range
+    entry_date = db.Column(db.DateTime, default=datetime.utcnow)
 
 class ReceptionSheet(db.Model):
     __tablename__ = 'reception_sheets'
+    __table_args__ = (
+        db.Index('ix_reception_sheets_site_date', 'site', 'reception_date'),
+        db.Index('ix_reception_sheets_date', 'reception_date', 'id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
+    site = db.Column(db.String(50))
     reception_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     supplier = db.Column(db.String(200), nullable=False)
     document_number = db.Column(db.String(100))
@@ -55,21 +142,24 @@ class ReceptionSheet(db.Model):
 
 class ReceptionItem(db.Model):
     __tablename__ = 'reception_items'
+    __table_args__ = (
+        db.Index('ix_reception_items_product_date', 'product_id', 'entry_date', 'id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     reception_id = db.Column(db.Integer, db.ForeignKey('reception_sheets.id'), nullable=False)
     item_number = db.Column(db.Integer, nullable=False)
-    product_code = db.Column(db.String(50), nullable=False)
-    product_name = db.Column(db.String(200), nullable=False)
-    unit = db.Column(db.String(20), nullable=False)
-    quantity = db.Column(db.Float, nullable=False)
-    location = db.Column(db.String(100))
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id', ondelete='SET NULL'))
+    product_version_id = db.Column(db.Integer, db.ForeignKey('product_versions.id'), nullable=False)
+    quantity = db.Column(Quantity, nullable=False)
+    location_id = db.Column(db.Integer, db.ForeignKey('locations.id'))
     entry_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
 class DraftBill(db.Model):
     __tablename__ = 'draft_bills'
     
     id = db.Column(db.Integer, primary_key=True)
+    site = db.Column(db.String(50), index=True)
     employee_name = db.Column(db.String(100))
     employee_signature = db.Column(db.String(100))
     last_updated = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -83,16 +173,15 @@ class DraftBillItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     draft_id = db.Column(db.Integer, db.ForeignKey('draft_bills.id'), nullable=False)
     item_number = db.Column(db.Integer, nullable=False)
-    product_code = db.Column(db.String(50), nullable=False)
-    product_name = db.Column(db.String(200), nullable=False)
-    unit = db.Column(db.String(20), nullable=False)
-    quantity = db.Column(db.Float, nullable=False)
-    location = db.Column(db.String(100))
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id', ondelete='CASCADE'), nullable=False)
+    quantity = db.Column(Quantity, nullable=False)
+    location_id = db.Column(db.Integer, db.ForeignKey('locations.id'))
 
 class DraftReception(db.Model):
     __tablename__ = 'draft_receptions'
     
     id = db.Column(db.Integer, primary_key=True)
+    site = db.Column(db.String(50), index=True)
     supplier = db.Column(db.String(200))
     document_number = db.Column(db.String(100))
     notes = db.Column(db.Text)
@@ -107,8 +196,99 @@ class DraftReceptionItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     draft_id = db.Column(db.Integer, db.ForeignKey('draft_receptions.id'), nullable=False)
     item_number = db.Column(db.Integer, nullable=False)
-    product_code = db.Column(db.String(50), nullable=False)
-    product_name = db.Column(db.String(200), nullable=False)
-    unit = db.Column(db.String(20), nullable=False)
-    quantity = db.Column(db.Float, nullable=False)
-    location = db.Column(db.String(100))
\ No newline at end of file
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id', ondelete='CASCADE'), nullable=False)
+    quantity = db.Column(Quantity, nullable=False)
+    location_id = db.Column(db.Integer, db.ForeignKey('locations.id'))
+
+class DailyConsumption(db.Model):
+    __tablename__ = 'daily_consumption'
+    __table_args__ = (
+        db.UniqueConstraint('day', 'site', 'product_id', 'employee_name', name='uq_daily_consumption_key'),
+    )
+    
+    # Rollup of finalized bill lines, maintained on finalize; site '' for unscoped instances
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    site = db.Column(db.String(50), nullable=False, default='')
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id', ondelete='SET NULL'))
+    employee_name = db.Column(db.String(100), nullable=False)
+    quantity = db.Column(Quantity, nullable=False, default=0.0)
+    lines = db.Column(db.Integer, nullable=False, default=0)
+
+class DailyReception(db.Model):
+    __tablename__ = 'daily_reception'
+    __table_args__ = (
+        db.UniqueConstraint('day', 'site', 'product_id', 'supplier', name='uq_daily_reception_key'),
+    )
+    
+    # Rollup of finalized reception lines, maintained on finalize; site '' for unscoped instances
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    site = db.Column(db.String(50), nullable=False, default='')
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id', ondelete='SET NULL'))
+    supplier = db.Column(db.String(200), nullable=False)
+    quantity = db.Column(Quantity, nullable=False, default=0.0)
+    lines = db.Column(db.Integer, nullable=False, default=0)
+
+class ActivityEvent(db.Model):
+    __tablename__ = 'activity_events'
+    
+    # Outbox for the live feed on databases without LISTEN/NOTIFY
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    site = db.Column(db.String(50))
+    payload = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class SyncJournal(db.Model):
+    __tablename__ = 'sync_journal'
+    
+    # Edge node outbox: finalized documents and stock deltas waiting to reach the central database
+    id = db.Column(db.Integer, primary_key=True)
+    entry_id = db.Column(db.String(36), unique=True, nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    synced_at = db.Column(db.DateTime, index=True)
+
+class SyncState(db.Model):
+    __tablename__ = 'sync_state'
+    
+    # Edge node bookmarks, e.g. the catalog pull watermark
+    key = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.String(200))
+
+class SyncApplied(db.Model):
+    __tablename__ = 'sync_applied'
+    
+    # Central record of replayed journal entries; makes pushes idempotent
+    entry_id = db.Column(db.String(36), primary_key=True)
+    node_id = db.Column(db.String(100), nullable=False)
+    batch_id = db.Column(db.String(36), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class SyncConflict(db.Model):
+    __tablename__ = 'sync_conflicts'
+    
+    # Lines from edge nodes that could not be applied cleanly, for review
+    id = db.Column(db.Integer, primary_key=True)
+    entry_id = db.Column(db.String(36), nullable=False, index=True)
+    node_id = db.Column(db.String(100), nullable=False)
+    product_code = db.Column(db.String(50))
+    reason = db.Column(db.String(50), nullable=False)
+    detail = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+    __table_args__ = (
+        db.UniqueConstraint('endpoint', 'key', name='uq_idempotency_keys_endpoint_key'),
+    )
+    
+    # Client-chosen key of a finalize/batch submission and the response it got, for replaying retries
+    id = db.Column(db.Integer, primary_key=True)
+    endpoint = db.Column(db.String(50), nullable=False)
+    key = db.Column(db.String(100), nullable=False)
+    document_id = db.Column(db.Integer)
+    response = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
@@ -0,0 +1,118 @@
+"""Fixed-point quantities.
+
+Quantities are stored as integers counting thousandths of a unit
+(QUANTITY_SCALE), so `quantity = quantity + :delta`, SUM() and comparisons
+are exact integer arithmetic on every database and repeated stock moves never
+drift. The Quantity column type does the scaling, so Python code keeps reading
+and writing plain numbers.
+
+How many of those three decimals a unit may use (none for pieces, three for
+kilograms) comes from the units table, seeded from DEFAULT_UNIT_DECIMALS.
+Quantities with more decimals than their unit allows are rejected on input.
+"""
+import math
+import threading
+import time
+
+from sqlalchemy import BigInteger, Integer
+from sqlalchemy.sql import operators
+from sqlalchemy.types import TypeDecorator
+
+QUANTITY_SCALE = 1000
+MAX_DECIMALS = 3
+# Stored thousandths must fit the signed 64-bit columns
+STORED_LIMIT = 2 ** 63
+
+# Seeded into the units table; units missing from it may use all MAX_DECIMALS
+DEFAULT_UNIT_DECIMALS = {
+    'buc': 0,
+    'set': 0,
+    'pereche': 0,
+    'cutie': 0,
+    'kg': 3,
+    'g': 0,
+    'l': 3,
+    'ml': 0,
+    'm': 2,
+    'mp': 2,
+    'mc': 3,
+}
+
+UNITS_RELOAD_SECONDS = 60
+
+# Factors in quantity expressions are plain numbers, not quantities
+_UNSCALED_OPERATORS = {operators.mul, operators.truediv, operators.floordiv}
+# Arithmetic on a quantity that yields a quantity, still scaled
+_QUANTITY_OPERATORS = {operators.add, operators.sub, operators.neg} | _UNSCALED_OPERATORS
+
+
+class Quantity(TypeDecorator):
+    """Number stored as a BIGINT count of 1/QUANTITY_SCALE units"""
+
+    impl = BigInteger
+    cache_ok = True
+
+    class Comparator(TypeDecorator.Comparator):
+        def _adapt_expression(self, op, other_comparator):
+            if op in _QUANTITY_OPERATORS:
+                return op, self.type
+            return super()._adapt_expression(op, other_comparator)
+
+    comparator_factory = Comparator
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return round(float(value) * QUANTITY_SCALE)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return round(value) / QUANTITY_SCALE
+
+    def coerce_compared_value(self, op, value):
+        if op in _UNSCALED_OPERATORS:
+            return Integer()
+        return self
+
+
+_units = {}
+_units_loaded_at = float('-inf')
+_units_lock = threading.Lock()
+
+
+def ensure_units():
+    """Seed the units table with the default precisions it doesn't have yet"""
+    from app import db
+    from models import Unit
+
+    existing = {code for (code,) in db.session.query(Unit.code)}
+    for code, decimals in DEFAULT_UNIT_DECIMALS.items():
+        if code not in existing:
+            db.session.add(Unit(code=code, decimals=decimals))
+
+
+def unit_decimals(unit):
+    """Decimals a quantity in this unit may have; reloaded from the units table every minute"""
+    global _units, _units_loaded_at
+    from app import db
+    from models import Unit
+
+    if time.monotonic() - _units_loaded_at >= UNITS_RELOAD_SECONDS:
+        units = {code.lower(): min(decimals, MAX_DECIMALS) for code, decimals in db.session.query(Unit.code, Unit.decimals)}
+        with _units_lock:
+            _units, _units_loaded_at = units, time.monotonic()
+    return _units.get((unit or '').strip().lower(), MAX_DECIMALS)
+
+
+def quantity_error(quantity, unit):
+    """Message for a quantity that can't be stored or has more decimals than its unit allows, None when it is fine"""
+    if not math.isfinite(quantity) or abs(quantity) * QUANTITY_SCALE >= STORED_LIMIT:
+        return 'Cantitate invalidă'
+    decimals = unit_decimals(unit)
+    scaled = quantity * 10 ** decimals
+    if abs(scaled - round(scaled)) > 1e-9 * max(1.0, abs(scaled)):
+        if decimals == 0:
+            return f'Cantitatea în {unit} trebuie să fie un număr întreg'
+        return f'Cantitatea în {unit} poate avea cel mult {decimals} zecimale'
+    return None
@@ -0,0 +1,174 @@
+"""Monthly consumption and reception summaries.
+
+Finalizing a bill or reception adds its lines to daily rollup tables
+(daily_consumption, daily_reception), keyed by day, site, product and
+employee/supplier. Reports group those rollups in the database, so a monthly
+summary reads one row per product and day instead of every line item.
+rebuild_rollups() recomputes a date range from the line tables, live and
+archived, when the rollups need backfilling.
+"""
+import io
+from collections import defaultdict
+from datetime import MAXYEAR, MINYEAR, date
+
+import openpyxl
+from openpyxl.styles import Font, Border, Side
+from openpyxl.utils import get_column_letter
+from sqlalchemy import func, select, literal_column
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app import db
+from models import Product, DailyConsumption, DailyReception
+from archive import DOCUMENTS, is_postgres
+
+THIN_BORDER = Border(
+    top=Side(style='thin'),
+    bottom=Side(style='thin'),
+    left=Side(style='thin'),
+    right=Side(style='thin')
+)
+
+# Years a monthly range can cover: month_range() needs the following month's first day
+REPORT_YEARS = range(MINYEAR, MAXYEAR)
+
+# document kind -> (rollup model, party column on the rollup, party column on the document)
+ROLLUPS = {
+    'bill': (DailyConsumption, 'employee_name', 'employee_name'),
+    'reception': (DailyReception, 'supplier', 'supplier'),
+}
+
+
+def _upsert(model, key, quantity, lines):
+    dialect = postgresql if is_postgres() else sqlite
+    statement = dialect.insert(model).values(**key, quantity=quantity, lines=lines)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=list(key),
+        set_={'quantity': model.quantity + statement.excluded.quantity,
+              'lines': model.lines + statement.excluded.lines}))
+
+
+def record_document(kind, document):
+    """Add a just-finalized document's lines to its daily rollup, in the same transaction"""
+    model, party_column, document_party = ROLLUPS[kind]
+    date_column = DOCUMENTS[kind][2]
+    totals = defaultdict(lambda: [0.0, 0])
+    for item in document.items:
+        totals[item.product_id][0] += item.quantity
+        totals[item.product_id][1] += 1
+
+    day = getattr(document, date_column).date()
+    for product_id, (quantity, lines) in totals.items():
+        _upsert(model, {'day': day, 'site': document.site or '', 'product_id': product_id,
+                        party_column: getattr(document, document_party)},
+                quantity, lines)
+
+
+def rebuild_rollups(start, end):
+    """Recompute rollups for days in [start, end) from live and archived lines"""
+    for kind, (model, party_column, document_party) in ROLLUPS.items():
+        documents, archived, date_column, items, archived_items, item_fk = DOCUMENTS[kind]
+        sources = [(documents, items)] if is_postgres() else [(documents, items), (archived, archived_items)]
+
+        db.session.execute(model.__table__.delete().where(model.day >= start, model.day < end))
+        for document_table, item_table in sources:
+            day = func.date(document_table.c[date_column])
+            site = func.coalesce(document_table.c.site, literal_column("''"))
+            party = document_table.c[document_party]
+            query = (
+                select(day, site, item_table.c.product_id, party,
+                       func.sum(item_table.c.quantity), func.count())
+                .join(document_table, document_table.c.id == item_table.c[item_fk])
+                .where(document_table.c[date_column] >= start, document_table.c[date_column] < end)
+                .group_by(day, site, item_table.c.product_id, party)
+            )
+            db.session.execute(model.__table__.insert().from_select(
+                ['day', 'site', 'product_id', party_column, 'quantity', 'lines'], query))
+    db.session.commit()
+
+
+def month_range(year, month):
+    start = date(year, month, 1)
+    end = date(year + month // 12, month % 12 + 1, 1)
+    return start, end
+
+
+def _scoped(query, model, start, end, site):
+    query = query.filter(model.day >= start, model.day < end)
+    if site is not None:
+        query = query.filter(model.site == site)
+    return query
+
+
+def by_product(model, start, end, site=None):
+    """Rows of (code, name, unit, quantity, lines) per product over the range"""
+    quantity = func.sum(model.quantity)
+    query = (
+        db.session.query(Product.code, Product.name, Product.unit,
+                         quantity.label('quantity'), func.sum(model.lines).label('lines'))
+        .select_from(model)
+        .outerjoin(Product, Product.id == model.product_id)
+        .group_by(Product.code, Product.name, Product.unit)
+    )
+    return _scoped(query, model, start, end, site).order_by(quantity.desc()).all()
+
+
+def by_party(model, party_column, start, end, site=None):
+    """Rows of (party, products, quantity, lines) per employee or supplier over the range"""
+    party = getattr(model, party_column)
+    quantity = func.sum(model.quantity)
+    query = (
+        db.session.query(party.label('party'), func.count(func.distinct(model.product_id)).label('products'),
+                         quantity.label('quantity'), func.sum(model.lines).label('lines'))
+        .group_by(party)
+    )
+    return _scoped(query, model, start, end, site).order_by(quantity.desc()).all()
+
+
+def by_product_and_party(model, party_column, start, end, site=None):
+    """Rows of (party, code, name, unit, quantity) per employee or supplier and product"""
+    party = getattr(model, party_column)
+    query = (
+        db.session.query(party.label('party'), Product.code, Product.name, Product.unit,
+                         func.sum(model.quantity).label('quantity'))
+        .select_from(model)
+        .outerjoin(Product, Product.id == model.product_id)
+        .group_by(party, Product.code, Product.name, Product.unit)
+    )
+    return _scoped(query, model, start, end, site).order_by(party, Product.code).all()
+
+
+def _write_sheet(wb, title, headers, rows):
+    ws = wb.create_sheet(title)
+    for col, header in enumerate(headers, 1):
+        cell = ws.cell(row=1, column=col, value=header)
+        cell.font = Font(bold=True)
+        cell.border = THIN_BORDER
+    for row, values in enumerate(rows, 2):
+        for col, value in enumerate(values, 1):
+            ws.cell(row=row, column=col, value=value if value is not None else '-').border = THIN_BORDER
+    for col in range(1, len(headers) + 1):
+        ws.column_dimensions[get_column_letter(col)].width = 20
+
+
+def monthly_summary_workbook(year, month, site=None):
+    """Multi-sheet monthly summary of consumption and receptions, as xlsx bytes"""
+    start, end = month_range(year, month)
+    product_headers = ['Cod Produs', 'Denumire', 'U.M.', 'Cantitate', 'Nr. Linii']
+
+    wb = openpyxl.Workbook()
+    wb.remove(wb.active)
+    _write_sheet(wb, 'Consum pe produs', product_headers,
+                 by_product(DailyConsumption, start, end, site))
+    _write_sheet(wb, 'Consum pe angajat', ['Angajat', 'Nr. Produse', 'Cantitate', 'Nr. Linii'],
+                 by_party(DailyConsumption, 'employee_name', start, end, site))
+    _write_sheet(wb, 'Consum angajat-produs', ['Angajat', 'Cod Produs', 'Denumire', 'U.M.', 'Cantitate'],
+                 by_product_and_party(DailyConsumption, 'employee_name', start, end, site))
+    _write_sheet(wb, 'Recepții pe produs', product_headers,
+                 by_product(DailyReception, start, end, site))
+    _write_sheet(wb, 'Recepții pe furnizor', ['Furnizor', 'Nr. Produse', 'Cantitate', 'Nr. Linii'],
+                 by_party(DailyReception, 'supplier', start, end, site))
+
+    output = io.BytesIO()
+    wb.save(output)
+    output.seek(0)
+    return output
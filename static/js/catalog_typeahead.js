@@ -0,0 +1,102 @@
+/*
+ * Product typeahead for the bill and reception create pages.
+ *
+ * The pages render no product list; they pass `catalog_url`, the versioned
+ * /catalog/products.json?v=N payload. It is downloaded once (the browser keeps
+ * it until the catalog version moves) and searched locally: exact code first,
+ * then codes starting with the text, then names containing it. Typing never
+ * hits the server.
+ *
+ *   const typeahead = new CatalogTypeahead(catalogUrl, codeInput, {
+ *       onSelect: (product) => { ... },   // {code, name, unit, location, stock}
+ *   });
+ */
+class CatalogTypeahead {
+    constructor(url, input, options = {}) {
+        this.input = input;
+        this.limit = options.limit ?? 20;
+        this.onSelect = options.onSelect ?? (() => {});
+        this.products = [];
+        this.byCode = new Map();
+
+        this.list = document.createElement('ul');
+        this.list.className = options.listClass ?? 'list-group catalog-typeahead';
+        this.input.setAttribute('autocomplete', 'off');
+        this.input.after(this.list);
+
+        this.input.addEventListener('input', () => this.render(this.search(this.input.value)));
+        this.input.addEventListener('keydown', (event) => {
+            // Scanners type the code and press Enter
+            if (event.key === 'Enter') {
+                const product = this.byCode.get(this.input.value.trim().toLowerCase());
+                if (product) {
+                    event.preventDefault();
+                    this.select(product);
+                }
+            }
+        });
+        this.ready = this.load(url);
+    }
+
+    async load(url) {
+        const response = await fetch(url, {credentials: 'same-origin'});
+        const payload = await response.json();
+        const column = Object.fromEntries(payload.fields.map((field, index) => [field, index]));
+        this.products = payload.products.map((row) => ({
+            code: row[column.code],
+            name: row[column.name],
+            unit: row[column.unit],
+            location: row[column.location],
+            stock: row[column.stock],
+            codeKey: String(row[column.code]).toLowerCase(),
+            nameKey: String(row[column.name]).toLowerCase(),
+        }));
+        this.byCode = new Map(this.products.map((product) => [product.codeKey, product]));
+    }
+
+    search(text) {
+        const query = text.trim().toLowerCase();
+        if (!query) {
+            return [];
+        }
+
+        const exact = this.byCode.get(query);
+        const byCode = [];
+        const byName = [];
+        for (const product of this.products) {
+            if (byCode.length >= this.limit) {
+                break;
+            }
+            if (product === exact) {
+                continue;
+            }
+            if (product.codeKey.startsWith(query)) {
+                byCode.push(product);
+            } else if (byName.length < this.limit && product.nameKey.includes(query)) {
+                byName.push(product);
+            }
+        }
+        return [...(exact ? [exact] : []), ...byCode, ...byName].slice(0, this.limit);
+    }
+
+    render(products) {
+        this.list.replaceChildren(...products.map((product) => {
+            const item = document.createElement('li');
+            item.className = 'list-group-item list-group-item-action';
+            item.textContent = `${product.code} - ${product.name} (${product.stock} ${product.unit})`;
+            item.addEventListener('mousedown', (event) => {
+                event.preventDefault();
+                this.select(product);
+            });
+            return item;
+        }));
+    }
+
+    select(product) {
+        this.input.value = product.code;
+        this.list.replaceChildren();
+        this.onSelect(product);
+    }
+}
+
+window.CatalogTypeahead = CatalogTypeahead;
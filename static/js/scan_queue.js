@@ -0,0 +1,89 @@
+/*
+ * Scan queue for the bill and reception create pages.
+ *
+ * Barcode scanners fire scans faster than one request per scan can keep up
+ * with. Scans are buffered and sent to the batch endpoint
+ * (/consumption_bills/add_items or /reception/add_items) when the scanner goes
+ * quiet for `debounceMs`, or as soon as `maxBatch` scans are waiting. Only one
+ * request is in flight at a time; scans arriving meanwhile form the next batch.
+ * Network failures, server errors and 409s (the same key still being applied
+ * by an earlier attempt) retry the same batch with the same Idempotency-Key,
+ * so a batch the server applied but whose response was lost is not added
+ * twice, and one still in progress is picked up once it finishes.
+ * Per-line errors are reported through onResult.
+ *
+ *   const queue = new ScanQueue('/consumption_bills/add_items', {
+ *       onResult: (scan, result) => { ... },   // result: {success, item_number | error}
+ *       onItems: (items) => renderItems(items), // full item list after each batch
+ *   });
+ *   queue.push(code, quantity);
+ */
+class ScanQueue {
+    constructor(url, options = {}) {
+        this.url = url;
+        this.debounceMs = options.debounceMs ?? 150;
+        this.maxBatch = options.maxBatch ?? 50;
+        this.retryMs = options.retryMs ?? 2000;
+        this.onResult = options.onResult ?? (() => {});
+        this.onItems = options.onItems ?? (() => {});
+        this.onError = options.onError ?? (() => {});
+        this.pending = [];
+        this.retry = null;
+        this.timer = null;
+        this.inFlight = false;
+    }
+
+    push(productCode, quantity, location) {
+        this.pending.push({product_code: productCode, quantity: quantity, location: location});
+        if (this.pending.length >= this.maxBatch) {
+            this.flush();
+        } else {
+            clearTimeout(this.timer);
+            this.timer = setTimeout(() => this.flush(), this.debounceMs);
+        }
+    }
+
+    async flush() {
+        clearTimeout(this.timer);
+        if (this.inFlight || (this.retry === null && this.pending.length === 0)) {
+            return;
+        }
+
+        // A failed batch goes out again, unchanged and under its key, before newer scans
+        const {key, batch} = this.retry ?? {key: crypto.randomUUID(), batch: this.pending.splice(0, this.maxBatch)};
+        this.retry = null;
+        this.inFlight = true;
+        try {
+            const response = await fetch(this.url, {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json', 'Idempotency-Key': key},
+                body: JSON.stringify({items: batch}),
+                credentials: 'same-origin',
+            });
+            const body = await response.json().catch(() => ({}));
+            if (response.status === 409 || response.status >= 500) {
+                // The batch may yet be (or already have been) applied; only its key can tell
+                throw new Error(body.error || response.statusText);
+            }
+            if (!response.ok) {
+                this.onError(body.error || response.statusText, batch);
+            } else {
+                body.results.forEach((result) => this.onResult(batch[result.index], result));
+                this.onItems(body.items);
+            }
+        } catch (error) {
+            this.retry = {key, batch};
+            this.onError(error, batch);
+            this.timer = setTimeout(() => this.flush(), this.retryMs);
+            return;
+        } finally {
+            this.inFlight = false;
+        }
+
+        if (this.pending.length > 0) {
+            this.flush();
+        }
+    }
+}
+
+window.ScanQueue = ScanQueue;
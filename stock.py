@@ -0,0 +1,211 @@
+"""Per-location stock helpers.
+
+Product.quantity is the running total over all of a product's ProductStock rows.
+Every stock movement goes through apply_stock_delta() so the location row and the
+total change in the same transaction, and the total never has to be re-summed.
+"""
+from datetime import datetime
+
+from sqlalchemy import func, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app import app, db
+from models import Product, Location, ProductStock
+from archive import is_postgres
+
+DEFAULT_LOCATION = 'GENERAL'
+
+
+def current_site():
+    """Site served by this instance, or None for a central (unscoped) instance"""
+    return app.config.get('INVENTORY_SITE')
+
+
+def site_filter(query, site, column=None):
+    """Restrict a query to one site's rows; a None site leaves it unscoped"""
+    if site is None:
+        return query
+    return query.filter((column if column is not None else Location.site) == site)
+
+
+def find_location(code, site=None):
+    """Location with the given code inside the site"""
+    return site_filter(Location.query.filter(Location.code == code), site).order_by(Location.id).first()
+
+
+def _insert(model):
+    return (postgresql if is_postgres() else sqlite).insert(model)
+
+
+def get_or_create_location(code, site=None):
+    """Location with the given code inside the site, created if missing.
+
+    The insert skips a row another worker created first, so concurrent first
+    uses of a code end up sharing one location.
+    """
+    code = (code or '').strip() or DEFAULT_LOCATION
+    location = Location.query.filter_by(site=site, code=code).first()
+    if location is None:
+        db.session.execute(
+            _insert(Location).values(site=site, code=code, name=code, created_at=datetime.utcnow())
+            .on_conflict_do_nothing()
+        )
+        location = Location.query.filter_by(site=site, code=code).one()
+    return location
+
+
+def stock_at(product_id, location_id):
+    """Quantity of a product held at one location"""
+    quantity = db.session.query(ProductStock.quantity).filter_by(
+        product_id=product_id, location_id=location_id).scalar()
+    return quantity or 0.0
+
+
+def stock_by_product(product_ids, site=None):
+    """{product_id: [(location, quantity)]} inside the site, fullest location first, in one query"""
+    rows = {}
+    if not product_ids:
+        return rows
+    query = site_filter(
+        db.session.query(ProductStock.product_id, Location, ProductStock.quantity)
+        .join(Location, Location.id == ProductStock.location_id)
+        .filter(ProductStock.product_id.in_(product_ids)),
+        site
+    ).order_by(ProductStock.quantity.desc(), Location.id)
+    for product_id, location, quantity in query:
+        rows.setdefault(product_id, []).append((location, quantity))
+    return rows
+
+
+def pick_location_from(product, stock_rows, site=None, location_code=None):
+    """Location a document line for the product should use, given its stock rows in the site.
+
+    An explicit location code must exist inside the site. Otherwise the site's
+    location holding most of the product wins, falling back to the product's
+    default location (created in the site on first use).
+    """
+    if location_code:
+        for location, _ in stock_rows:
+            if location.code == location_code:
+                return location
+        return find_location(location_code, site)
+
+    if stock_rows:
+        return stock_rows[0][0]
+
+    return get_or_create_location(product.location, site)
+
+
+def pick_location(product, site=None, location_code=None):
+    """Location a document line for one product should use"""
+    return pick_location_from(product, stock_by_product([product.id], site).get(product.id, []), site, location_code)
+
+
+def apply_stock_delta(product_id, location_id, delta):
+    """Move stock at one location and keep the product total in step"""
+    # One upsert, so two first-time moves into the same location can't both insert the row
+    statement = _insert(ProductStock).values(
+        product_id=product_id, location_id=location_id, quantity=delta, updated_at=datetime.utcnow())
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['product_id', 'location_id'],
+        set_={'quantity': ProductStock.quantity + statement.excluded.quantity,
+              'updated_at': statement.excluded.updated_at}))
+
+    db.session.execute(
+        update(Product)
+        .where(Product.id == product_id)
+        .values(quantity=Product.quantity + delta)
+    )
+
+
+def site_quantity(product_id, site=None):
+    """Quantity of a product held inside the site; the catalog total for an unscoped instance"""
+    query = site_filter(
+        db.session.query(func.coalesce(func.sum(ProductStock.quantity), 0.0))
+        .join(Location, Location.id == ProductStock.location_id)
+        .filter(ProductStock.product_id == product_id),
+        site
+    )
+    return query.scalar()
+
+
+def stocked_outside(product_id, site):
+    """Whether a product has stock rows at locations of other sites"""
+    if site is None:
+        return False
+    query = (
+        db.session.query(ProductStock.id)
+        .join(Location, Location.id == ProductStock.location_id)
+        .filter(ProductStock.product_id == product_id, Location.site.is_distinct_from(site))
+    )
+    return db.session.query(query.exists()).scalar()
+
+
+def set_stock(product, quantity, location, site=None):
+    """Set a product's quantity inside the site from the edit form, absorbing the difference at one location.
+
+    Returns the delta applied. Other sites' stock is left alone.
+    """
+    delta = quantity - site_quantity(product.id, site)
+    if delta:
+        apply_stock_delta(product.id, location.id, delta)
+    return delta
+
+
+def _site_stock_query(site, location_code=None):
+    total = func.sum(ProductStock.quantity)
+    query = (
+        db.session.query(
+            Product.id, Product.code, Product.name, Product.unit,
+            Product.min_stock, Product.location, total.label('quantity'))
+        .join(ProductStock, ProductStock.product_id == Product.id)
+        .join(Location, Location.id == ProductStock.location_id)
+    )
+    query = site_filter(query, site)
+    if location_code:
+        query = query.filter(Location.code == location_code)
+    return query.group_by(
+        Product.id, Product.code, Product.name, Product.unit, Product.min_stock, Product.location), total
+
+
+def low_stock_products(site=None, location_code=None):
+    """Products at or below minimum stock, counted over the site (or one location)"""
+    if site is None and not location_code:
+        return Product.query.filter(Product.quantity <= Product.min_stock).order_by(Product.quantity.asc()).all()
+
+    query, total = _site_stock_query(site, location_code)
+    return query.having(total <= Product.min_stock).order_by(total.asc()).all()
+
+
+def site_products(site=None, location_code=None):
+    """Products stocked in the site (or one location) with their scoped quantity"""
+    query, _ = _site_stock_query(site, location_code)
+    return query.order_by(Product.name)
+
+
+def count_products(site=None, location_code=None):
+    """Number of distinct products stocked in the site (or one location)"""
+    if site is None and not location_code:
+        return Product.query.count()
+
+    query = db.session.query(func.count(func.distinct(ProductStock.product_id))).join(
+        Location, Location.id == ProductStock.location_id)
+    query = site_filter(query, site)
+    if location_code:
+        query = query.filter(Location.code == location_code)
+    return query.scalar()
+
+
+def backfill_product_stock(site=None):
+    """Give every product without stock rows one row at its default location"""
+    missing = (
+        Product.query
+        .outerjoin(ProductStock, ProductStock.product_id == Product.id)
+        .filter(ProductStock.id.is_(None))
+        .all()
+    )
+    for product in missing:
+        location = get_or_create_location(product.location, site)
+        db.session.add(ProductStock(product_id=product.id, location_id=location.id,
+                                    quantity=product.quantity or 0.0))
+    return len(missing)
@@ -0,0 +1,160 @@
+"""Bulk stock arithmetic over the whole catalog with NumPy.
+
+Quantities are stored as integer thousandths (see quantities.py), so totals are
+read raw, as BIGINT, and summed into int64 vectors indexed by product id:
+every sum and comparison is exact, with no float tolerance. Rows are read
+CHUNK_ROWS at a time, so a check over millions of lines keeps one chunk in
+memory instead of one Python object per row. Product codes are only looked
+up for the products a check reports.
+
+reconcile() checks the invariants stock changes rely on; low_stock() and
+movement_totals() answer catalog-wide questions for reports and the CLI.
+"""
+import numpy as np
+from sqlalchemy import BigInteger, func, select, type_coerce
+
+from app import db
+from models import Product, ProductStock, Location, DailyConsumption, DailyReception
+from quantities import QUANTITY_SCALE
+from stock import site_filter
+from archive import DOCUMENTS, is_postgres
+from reports import ROLLUPS
+
+CHUNK_ROWS = 50_000
+# Ids per IN (...) when looking up codes, under SQLite's bound parameter limit
+CODE_BATCH = 900
+
+
+def _raw(column):
+    """The stored integer behind a quantity column or expression"""
+    return type_coerce(column, BigInteger)
+
+
+def _catalog():
+    """Product ids, quantities and minimums as vectors, ordered by id"""
+    result = db.session.execute(
+        select(Product.id, _raw(Product.quantity), func.coalesce(_raw(Product.min_stock), 0))
+        .order_by(Product.id)
+        .execution_options(yield_per=CHUNK_ROWS)
+    )
+    chunks = [np.array([tuple(map(int, row)) for row in chunk], dtype=np.int64).reshape(-1, 3)
+              for chunk in result.partitions()]
+    catalog = np.concatenate(chunks) if chunks else np.empty((0, 3), dtype=np.int64)
+    return catalog[:, 0], catalog[:, 1], catalog[:, 2]
+
+
+def _codes(ids):
+    """Codes of the given product ids, read only for the products being reported"""
+    codes = {}
+    ids = [int(product_id) for product_id in ids]
+    for start in range(0, len(ids), CODE_BATCH):
+        batch = ids[start:start + CODE_BATCH]
+        codes.update(db.session.execute(select(Product.id, Product.code).where(Product.id.in_(batch))).all())
+    return codes
+
+
+def _totals(query, ids):
+    """Sum the (product_id, raw quantity) rows of query per product, aligned with ids"""
+    totals = np.zeros(len(ids), dtype=np.int64)
+    result = db.session.execute(query.execution_options(yield_per=CHUNK_ROWS))
+    for chunk in result.partitions():
+        pairs = np.array([(product_id, int(quantity)) for product_id, quantity in chunk
+                          if product_id is not None], dtype=np.int64).reshape(-1, 2)
+        # Lines of deleted products have nowhere to go
+        positions = np.searchsorted(ids, pairs[:, 0])
+        known = positions < len(ids)
+        known[known] = ids[positions[known]] == pairs[known, 0]
+        np.add.at(totals, positions[known], pairs[known, 1])
+    return totals
+
+
+def _stock_query(site=None):
+    query = select(ProductStock.product_id, func.sum(_raw(ProductStock.quantity))).group_by(ProductStock.product_id)
+    if site is not None:
+        query = site_filter(query.join(Location, Location.id == ProductStock.location_id), site)
+    return query
+
+
+def _line_queries(kind):
+    """Per-product line totals of a document kind, live and archived"""
+    _, _, _, items, archived_items, _ = DOCUMENTS[kind]
+    tables = [items] if is_postgres() else [items, archived_items]
+    return [select(table.c.product_id, func.sum(_raw(table.c.quantity))).group_by(table.c.product_id)
+            for table in tables]
+
+
+def _quantities(raw):
+    return raw / QUANTITY_SCALE
+
+
+def _mismatches(check, ids, expected, actual):
+    wrong = np.flatnonzero(expected != actual)
+    codes = _codes(ids[wrong])
+    return [{'check': check, 'code': codes[ids[index]],
+             'expected': float(_quantities(expected[index])), 'actual': float(_quantities(actual[index]))}
+            for index in wrong]
+
+
+def reconcile():
+    """Products whose stored totals disagree with the rows they summarize.
+
+    - Product.quantity against the sum of its per-location stock rows
+    - no negative per-location stock
+    - daily consumption and reception rollups against the bill and reception lines
+    """
+    ids, quantity, _ = _catalog()
+    stock = _totals(_stock_query(), ids)
+    problems = _mismatches('stoc pe locații', ids, stock, quantity)
+
+    negative = db.session.execute(
+        select(Product.code, Location.code, ProductStock.quantity)
+        .join(Product, Product.id == ProductStock.product_id)
+        .join(Location, Location.id == ProductStock.location_id)
+        .where(_raw(ProductStock.quantity) < 0)
+    ).all()
+    problems += [{'check': f'stoc negativ la {location}', 'code': code, 'expected': 0.0, 'actual': amount}
+                 for code, location, amount in negative]
+
+    for kind, (model, _, _) in ROLLUPS.items():
+        lines = sum(_totals(query, ids) for query in _line_queries(kind))
+        rollup = _totals(select(model.product_id, func.sum(_raw(model.quantity))).group_by(model.product_id), ids)
+        problems += _mismatches(f'rollup {model.__tablename__}', ids, lines, rollup)
+    return problems
+
+
+def low_stock(site=None):
+    """(code, quantity, min_stock) of products at or below their minimum, lowest stock first.
+
+    Quantities are the site's stock when a site is given, otherwise the catalog totals.
+    """
+    ids, quantity, min_stock = _catalog()
+    if site is not None:
+        quantity = _totals(_stock_query(site), ids)
+    low = np.flatnonzero(quantity <= min_stock)
+    low = low[np.argsort(quantity[low], kind='stable')]
+    codes = _codes(ids[low])
+    return [(codes[ids[index]], float(_quantities(quantity[index])), float(_quantities(min_stock[index])))
+            for index in low]
+
+
+def movement_totals(start, end, site=None):
+    """Per product (code, received, consumed, net) over days [start, end), from the daily rollups"""
+    ids, _, _ = _catalog()
+    moved = {}
+    for model in (DailyReception, DailyConsumption):
+        query = (
+            select(model.product_id, func.sum(_raw(model.quantity)))
+            .where(model.day >= start, model.day < end)
+            .group_by(model.product_id)
+        )
+        if site is not None:
+            query = query.where(model.site == site)
+        moved[model] = _totals(query, ids)
+
+    received, consumed = moved[DailyReception], moved[DailyConsumption]
+    active = np.flatnonzero((received != 0) | (consumed != 0))
+    net = received - consumed
+    codes = _codes(ids[active])
+    return [(codes[ids[index]], float(_quantities(received[index])), float(_quantities(consumed[index])),
+             float(_quantities(net[index])))
+            for index in active]
@@ -0,0 +1,284 @@
+"""Concurrent finalize load harness.
+
+`flask --app app stress` forks N worker processes against the configured
+database (SQLite or PostgreSQL). Each worker drives the real routes through
+its own test client and session, like a terminal would: add_item a few random
+STRESS-* products, then finalize_consumption_bill or finalize_reception.
+Finalizes that fail on a lock (SQLite "database is locked", PostgreSQL
+deadlocks and lock timeouts) are retried with backoff and counted.
+
+Afterwards every STRESS-* product must satisfy
+
+    quantity == quantity before + received - consumed
+
+counted both from the bill/reception lines written during the run and from
+what the workers saw succeed, and its per-location stock rows must add up to
+Product.quantity. Quantities are compared as the stored integer thousandths, so
+even a one-thousandth drift is reported. The report gives throughput, finalize
+latency, lock waits and retries.
+
+Lock waits are measured in each worker by timing its write statements: SQLite
+waits for the write lock inside busy_timeout and PostgreSQL on row locks, both
+within the statement, so the time a statement takes beyond the fastest run of
+the same SQL is counted as waiting.
+
+The harness writes real documents: point DATABASE_URL at a scratch database.
+"""
+import multiprocessing
+import random
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlparse
+
+from sqlalchemy import BigInteger, event, func, text, type_coerce
+
+from app import app, db
+from models import Product, ProductStock, BillItem, ReceptionItem
+from stock import current_site, get_or_create_location, apply_stock_delta
+from lines import current_version
+from archive import is_postgres
+from catalog_cache import bump_catalog_version
+from quantities import QUANTITY_SCALE
+from logging_setup import flush_logging
+
+CODE_PREFIX = 'STRESS-'
+# Error text of failed finalizes that are worth retrying
+LOCK_ERRORS = ('database is locked', 'deadlock detected', 'could not serialize', 'lock timeout')
+MAX_RETRIES = 8
+LOCK_SAMPLE_SECONDS = 0.1
+# Statement time beyond the fastest run of the same SQL that counts as a lock wait, not noise
+LOCK_WAIT_MIN_SECONDS = 0.002
+
+DOCUMENT_ROUTES = {
+    'bill': ('/consumption_bills/add_item', '/consumption_bills/finalize', '/consumption_bills',
+             lambda worker: {'employee_name': f'stress-{worker}', 'employee_signature': 'stress'}),
+    'reception': ('/reception/add_item', '/reception/finalize', '/reception',
+                  lambda worker: {'supplier': f'stress-{worker}', 'document_number': '', 'notes': ''}),
+}
+
+
+def seed_products(count, initial_quantity):
+    """Create missing STRESS-* products with initial_quantity at the default location"""
+    site = current_site()
+    codes = [f'{CODE_PREFIX}{number:04d}' for number in range(1, count + 1)]
+    existing = {code for (code,) in db.session.query(Product.code).filter(Product.code.in_(codes))}
+    for code in codes:
+        if code in existing:
+            continue
+        product = Product(code=code, name=f'Stress {code}', unit='buc', quantity=0.0, location=None, min_stock=0.0)
+        db.session.add(product)
+        db.session.flush()
+        current_version(product)
+        apply_stock_delta(product.id, get_or_create_location(None, site).id, initial_quantity)
+    bump_catalog_version()
+    db.session.commit()
+    return codes
+
+
+def _raw(column):
+    """The stored integer thousandths behind a quantity column or expression"""
+    return type_coerce(column, BigInteger)
+
+
+def snapshot(codes):
+    """code -> (quantity, received, consumed, stock row total) for the given products, in thousandths"""
+    received = (
+        db.session.query(ReceptionItem.product_id, func.sum(_raw(ReceptionItem.quantity)))
+        .group_by(ReceptionItem.product_id).subquery()
+    )
+    consumed = (
+        db.session.query(BillItem.product_id, func.sum(_raw(BillItem.quantity)))
+        .group_by(BillItem.product_id).subquery()
+    )
+    stock = (
+        db.session.query(ProductStock.product_id, func.sum(_raw(ProductStock.quantity)))
+        .group_by(ProductStock.product_id).subquery()
+    )
+    rows = (
+        db.session.query(Product.code, _raw(Product.quantity),
+                         func.coalesce(received.c[1], 0), func.coalesce(consumed.c[1], 0),
+                         func.coalesce(stock.c[1], 0))
+        .outerjoin(received, received.c.product_id == Product.id)
+        .outerjoin(consumed, consumed.c.product_id == Product.id)
+        .outerjoin(stock, stock.c.product_id == Product.id)
+        .filter(Product.code.in_(codes))
+    )
+    db.session.rollback()
+    return {code: [int(value) for value in values] for code, *values in rows}
+
+
+def _finalize(client, kind, worker, codes, rng, max_lines, stats):
+    add_url, finalize_url, done_path, form = DOCUMENT_ROUTES[kind]
+    lines = defaultdict(float)
+    for code in rng.sample(codes, rng.randint(1, min(max_lines, len(codes)))):
+        quantity = float(rng.randint(1, 5))
+        response = client.post(add_url, data={'product_code': code, 'quantity': quantity})
+        if response.status_code == 200:
+            lines[code] += quantity
+        else:
+            stats['add_errors'] += 1
+    if not lines:
+        return None
+
+    for attempt in range(MAX_RETRIES + 1):
+        started = time.perf_counter()
+        response = client.post(finalize_url, data=form(worker))
+        elapsed = time.perf_counter() - started
+        if response.status_code == 302 and urlparse(response.location).path == done_path:
+            stats['latencies'].append(elapsed)
+            return lines
+
+        with client.session_transaction() as session:
+            messages = [message for _, message in session.pop('_flashes', [])]
+        if attempt < MAX_RETRIES and any(error in message for message in messages for error in LOCK_ERRORS):
+            stats['retries'] += 1
+            stats['lock_wait'] += elapsed
+            time.sleep(rng.uniform(0, 0.01 * 2 ** attempt))
+            continue
+        stats['errors'] += 1
+        stats['last_error'] = '; '.join(messages) or f'HTTP {response.status_code}'
+        # Drop the stuck lines so the next document starts clean
+        with client.session_transaction() as session:
+            session.pop(f'{kind}_items', None)
+        return None
+
+
+def _time_writes(engine, durations):
+    """Collect the duration of every write statement this process runs, by SQL text"""
+    @event.listens_for(engine, 'before_cursor_execute')
+    def started(connection, cursor, statement, parameters, context, executemany):
+        connection.info['statement_started'] = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def finished(connection, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - connection.info.pop('statement_started', time.perf_counter())
+        if not statement.lstrip().upper().startswith('SELECT') or 'FOR UPDATE' in statement.upper():
+            durations[statement].append(elapsed)
+
+
+def _lock_waits(durations):
+    """(count, seconds) of statements that ran slower than the fastest run of the same SQL"""
+    waits = [elapsed - min(runs) for runs in durations.values() for elapsed in runs]
+    waits = [wait for wait in waits if wait >= LOCK_WAIT_MIN_SECONDS]
+    return len(waits), sum(waits)
+
+
+def _worker(worker, codes, iterations, max_lines, reception_ratio, seed, results):
+    # Connections inherited from the parent must not be shared across processes
+    db.engine.dispose(close=False)
+    rng = random.Random(seed)
+    stats = {'finalized': 0, 'lines': 0, 'retries': 0, 'lock_waits': 0, 'lock_wait': 0.0, 'errors': 0,
+             'add_errors': 0, 'latencies': [], 'last_error': None}
+    moved = defaultdict(int)
+    durations = defaultdict(list)
+    with app.app_context():
+        _time_writes(db.engine, durations)
+        client = app.test_client()
+        for _ in range(iterations):
+            kind = 'reception' if rng.random() < reception_ratio else 'bill'
+            lines = _finalize(client, kind, worker, codes, rng, max_lines, stats)
+            if lines is None:
+                continue
+            stats['finalized'] += 1
+            stats['lines'] += len(lines)
+            sign = 1 if kind == 'reception' else -1
+            for code, quantity in lines.items():
+                moved[code] += sign * round(quantity * QUANTITY_SCALE)
+    waits, waited = _lock_waits(durations)
+    stats['lock_waits'] += waits
+    stats['lock_wait'] += waited
+    results.put((stats, dict(moved)))
+    # multiprocessing ends the child with os._exit(), which skips the atexit log flush
+    flush_logging()
+
+
+def _sample_lock_waits(stop, samples):
+    """Count PostgreSQL backends waiting on a lock until stop is set"""
+    with app.app_context():
+        while not stop.is_set():
+            samples.append(db.session.execute(text('SELECT count(*) FROM pg_locks WHERE NOT granted')).scalar())
+            db.session.rollback()
+            time.sleep(LOCK_SAMPLE_SECONDS)
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_stress(workers=4, iterations=50, products=20, max_lines=5, reception_ratio=0.4,
+               initial_quantity=1_000_000.0, seed=None):
+    """Run the load, check the stock invariant and return the report"""
+    seed = random.randrange(2 ** 32) if seed is None else seed
+    codes = seed_products(products, initial_quantity)
+    before = snapshot(codes)
+
+    stop, lock_samples = threading.Event(), []
+    sampler = None
+    if is_postgres():
+        sampler = threading.Thread(target=_sample_lock_waits, args=(stop, lock_samples), daemon=True)
+        sampler.start()
+
+    # Fork so workers share the configured app; each drops its inherited connections first
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    processes = [context.Process(target=_worker, args=(worker, codes, iterations, max_lines, reception_ratio,
+                                                       seed + worker, results))
+                 for worker in range(workers)]
+    started = time.perf_counter()
+    for process in processes:
+        process.start()
+    collected = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    if sampler:
+        sampler.join()
+
+    totals = defaultdict(int)
+    latencies = []
+    summary = {'finalized': 0, 'lines': 0, 'retries': 0, 'lock_waits': 0, 'lock_wait': 0.0, 'errors': 0,
+               'add_errors': 0}
+    last_error = None
+    for stats, moved in collected:
+        for key in summary:
+            summary[key] += stats[key]
+        latencies.extend(stats['latencies'])
+        last_error = stats['last_error'] or last_error
+        for code, quantity in moved.items():
+            totals[code] += quantity
+
+    after = snapshot(codes)
+    violations = []
+    shown = lambda raw: f'{raw / QUANTITY_SCALE:g}'
+    for code in codes:
+        quantity0, received0, consumed0, _ = before[code]
+        quantity1, received1, consumed1, stock_total = after[code]
+        from_lines = quantity0 + (received1 - received0) - (consumed1 - consumed0)
+        if quantity1 != from_lines:
+            violations.append(f'{code}: quantity {shown(quantity1)} != {shown(from_lines)} from document lines')
+        if quantity1 != quantity0 + totals[code]:
+            violations.append(f'{code}: quantity {shown(quantity1)} != {shown(quantity0 + totals[code])} '
+                              f'from finalized workloads')
+        if quantity1 != stock_total:
+            violations.append(f'{code}: quantity {shown(quantity1)} != {shown(stock_total)} in location stock rows')
+
+    return {
+        'seed': seed,
+        'workers': workers,
+        'seconds': elapsed,
+        **summary,
+        'last_error': last_error,
+        'finalizes_per_second': summary['finalized'] / elapsed if elapsed else None,
+        'lines_per_second': summary['lines'] / elapsed if elapsed else None,
+        'latency_p50': _percentile(latencies, 0.5),
+        'latency_p95': _percentile(latencies, 0.95),
+        'latency_max': max(latencies, default=None),
+        'lock_waiters_max': max(lock_samples, default=None),
+        'lock_waiters_avg': sum(lock_samples) / len(lock_samples) if lock_samples else None,
+        'violations': violations,
+    }